@@ -0,0 +1,73 @@
+"""
+Times the ORM and the fast paths of ModelBase.create_all, with and without
+loading the instances back, over the same rows of a plain model, in a
+scratch sqlite db. Each run adds the rows, flushes
+and rolls back, so every run starts from an empty table.
+
+    python benchmarks/create_all.py [rows] [runs]
+"""
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from site.models.core import SQLAlchemyPlus
+
+db = SQLAlchemyPlus()
+
+
+class Item(db.Model):
+    __tablename__ = 'items'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer)
+    sku = db.Column(db.String(40))
+    quantity = db.Column(db.Integer)
+
+
+def rows(number):
+    return [{'order_id': i / 4, 'sku': 'SKU%06d' % i, 'quantity': 1 + i % 3}
+            for i in range(number)]
+
+
+def timed(list_of_kwargs, fast, load):
+    start = time()
+    Item.create_all([dict(kwargs) for kwargs in list_of_kwargs],
+                    fast=fast, commit=False, load=load)
+    db.session.flush()
+    seconds = time() - start
+    db.session.rollback()
+    db.session.expunge_all()
+    return seconds
+
+
+def main(number=100000, runs=3):
+    tmpdir = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(
+        tmpdir, 'create_all.db')
+    app.config['SQL_INSTRUMENTATION'] = False
+    db.init_app(app)
+    try:
+        with app.app_context():
+            db.create_all()
+            list_of_kwargs = rows(number)
+            print '%d rows, best of %d runs' % (number, runs)
+            for name, fast, load in (('orm', False, True),
+                                     ('fast', True, True),
+                                     ('ids', True, False)):
+                best = min(timed(list_of_kwargs, fast, load)
+                           for i in range(runs))
+                print '  %-5s %8.2f s  %10.0f rows/s' % (
+                    name, best, number / best)
+            db.session.remove()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,71 @@
+"""
+Times json_plus.dumps on every available backend over payloads shaped like
+the responses of the api: a page of shipments with their skus expanded, a
+single shipment, and the columnar form of a long list.
+
+    python benchmarks/json_backends.py [number]
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from site.json_plus import BACKENDS, dumps, use_backend
+
+
+def shipment(i):
+    created = datetime(2015, 1, 1) + timedelta(minutes=i)
+    return {
+        'id': i,
+        'user_id': 1000 + i % 50,
+        'status': ('in-queue', 'packed', 'dispatched', 'delivered')[i % 4],
+        'total_cost': Decimal('%d.%02d' % (100 + i % 900, i % 100)),
+        'created_at': created,
+        'last_acted_at': created + timedelta(hours=6),
+        'tracking_number': None if i % 3 else u'TRK%08d' % i,
+        'address': {
+            'name': u'Customer %d' % i,
+            'line1': u'%d, 2nd Cross, Indiranagar' % i,
+            'city': u'Bengaluru',
+            'pincode': u'5600%02d' % (i % 100),
+        },
+        'contents': [
+            {'sku_id': i * 10 + j, 'quantity': 1 + j,
+             'unit_price': Decimal('%d.50' % (10 * (j + 1))),
+             'label': u'U%d-OSKU-TSHIRT%d' % (i, j)}
+            for j in range(4)],
+        'tags': [u'priority', u'gift'] if i % 5 == 0 else [],
+    }
+
+
+def payloads():
+    page = [shipment(i) for i in range(100)]
+    rows = [shipment(i) for i in range(2000)]
+    columns = ['id', 'user_id', 'status', 'total_cost', 'created_at']
+    return [
+        ('list of 100 shipments',
+         {'status': 'success', 'result': page,
+          'total_pages': 20, 'total_items': 2000}),
+        ('one shipment', {'status': 'success', 'result': shipment(7)}),
+        ('columnar list of 2000 rows',
+         {'status': 'success', 'result': {
+             'columns': columns,
+             'rows': [[row[c] for c in columns] for row in rows]}}),
+    ]
+
+
+def main(number=200):
+    for label, payload in payloads():
+        print '%s (%d bytes)' % (label, len(dumps(payload)))
+        for name in sorted(BACKENDS):
+            use_backend(name)
+            seconds = timeit(lambda: dumps(payload), number=number)
+            print '  %-10s %8.2f ms per dumps' % (
+                name, seconds * 1000 / number)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -1,7 +1,7 @@
 from celery import Celery
 from flask import Flask, current_app, request, redirect, session
 from flask.ext.kvsession import KVSessionExtension
-from .middleware import HTTPMethodOverrideMiddleware
+from .middleware import HTTPMethodOverrideMiddleware, CompressionMiddleware
 from .views import (create_api_bp, dashboard_bp, create_admin,
                     standalone_pages_bp, store_bp, hooks_bp,
                     app_bp, integrations, market_bp)
@@ -11,7 +11,10 @@ from .vendorapp_assets import vendorapp_assets_env
 from .core import (fedex, listener, security,
                    internal_server_error, redis_store, csrf)
 from .models import db, user_datastore, vendor_datastore
+from .models.caching import (serialized_cache, count_cache, lookup_memo,
+                             query_cache)
 from .mailer import mailer
+from .webhooks import webhooks
 from authenticators import with_signed_authentication, with_basic_authentication
 from flask_debugtoolbar import DebugToolbarExtension
 import logging
@@ -100,6 +103,11 @@ def create_app(testing=False, database=db, config_env='INKMONKWEB_CONFIG',
     # app.errorhandler(400)(exception_response_json)
     database.init_app(app)
     listener.init_app(app)
+    serialized_cache.init_app(app, redis_store)
+    count_cache.init_app(app)
+    lookup_memo.init_app(app)
+    query_cache.init_app(app, redis_store)
+    webhooks.init_app(app)
     assets_env.init_app(app)
     mailer.init_app(app)
     if not app.config['TESTING']:
@@ -132,6 +140,11 @@ def create_app(testing=False, database=db, config_env='INKMONKWEB_CONFIG',
 
     fedex.init_app(app)
     # app.wsgi_app = HTTPMethodOverrideMiddleware(app.wsgi_app)
+    if app.config.get('COMPRESS_RESPONSES', True):
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app,
+            min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+            level=app.config.get('COMPRESS_LEVEL', 6))
     if initialize_blueprints:
         admin = create_admin()
         admin.init_app(app)
@@ -179,6 +192,11 @@ def create_api_app(database=db, config_env='INKMONKWEB_CONFIG'):
         mail_handler.setLevel(logging.ERROR)
         app.logger.addHandler(mail_handler)
     app.wsgi_app = HTTPMethodOverrideMiddleware(app.wsgi_app)
+    if app.config.get('COMPRESS_RESPONSES', True):
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app,
+            min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+            level=app.config.get('COMPRESS_LEVEL', 6))
     app.register_blueprint(
         create_api_bp('v1', authenticator=with_basic_authentication,
                       optional_authenticator=with_basic_authentication),
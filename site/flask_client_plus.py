@@ -1,6 +1,7 @@
+from contextlib import contextmanager
 from flask.testing import FlaskClient
-from flask.json import _json as json
-from .json_plus import _json_encoder
+from .json_plus import dumps, loads
+from .models.instrumentation import sql_instrumentation
 from toolspy import merge
 
 
@@ -8,24 +9,21 @@ class FlaskClientPlus(FlaskClient):
 
     def jpost(self, url, **kwargs):
         kwargs['content_type'] = "application/json"
-        kwargs['data'] = json.dumps(
-            kwargs['data'], default=_json_encoder)
+        kwargs['data'] = dumps(kwargs['data'])
         return self.post(url, **kwargs)
 
     def jput(self, url, **kwargs):
         kwargs['content_type'] = "application/json"
-        kwargs['data'] = json.dumps(
-            kwargs['data'], default=_json_encoder)
+        kwargs['data'] = dumps(kwargs['data'])
         return self.put(url, **kwargs)
 
     def jpatch(self, url, **kwargs):
         kwargs['content_type'] = "application/json"
-        kwargs['data'] = json.dumps(
-            kwargs['data'], default=_json_encoder)
+        kwargs['data'] = dumps(kwargs['data'])
         return self.patch(url, **kwargs)
 
     def jread(self, resp):
-        return json.loads(resp.data)
+        return loads(resp.data)
 
     def jget(self, *args, **kwargs):
         return self.jread(self.get(*args, **kwargs))
@@ -38,3 +36,22 @@ class FlaskClientPlus(FlaskClient):
             {file_key: (open(file_path, 'rb'), file_path)})
         return self.post(url, buffered=buffered, content_type=content_type,
                          **kwargs)
+
+    @contextmanager
+    def assert_max_queries(self, n):
+        """Fails if the requests made within the block run more than `n`
+        sql statements in all.
+
+        >>> with client.assert_max_queries(3):
+        ...     client.get('/json/shipments')
+        """
+        with sql_instrumentation.record() as query_record:
+            yield query_record
+        if query_record.count > n:
+            statements = list(query_record.statements)
+            if query_record.count > len(statements):
+                statements.append('... and %d more' % (
+                    query_record.count - len(statements)))
+            raise AssertionError(
+                '%d queries run, expected at most %d:\n%s' % (
+                    query_record.count, n, '\n'.join(statements)))
@@ -1,30 +1,123 @@
+"""
+The one json encoder of the app.
+
+`json_encoder` is the `default` hook used for everything that the json
+module cannot encode by itself. Instead of walking an isinstance chain for
+every object, it resolves a handler from `ENCODERS` once per concrete type
+and caches it.
+
+`dumps` encodes with a reusable encoder instance of the active backend. The
+stdlib json module is always available. simplejson is used instead when it
+is importable with its C speedups. `use_backend` switches explicitly.
+
+Decimals are strings with every backend, as they have always been in the
+json of the models.
+"""
+import json
+import logging
 from datetime import datetime
 from decimal import Decimal
-from .models import db
-from flask.json import _json
-from .utils import is_list_like, is_dict_like, dict_map
-from flask import current_app
+from .utils import LIST_LIKE_TYPES, DICT_LIKE_TYPES, dict_map
 
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
 
-def json_encoder(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, Decimal):
-        return str(obj)
-    elif isinstance(obj, unicode):
-        return obj
-    elif isinstance(obj, db.Model):
-        return obj.todict()
-    elif is_list_like(obj):
-        return [json_encoder(i) for i in obj]
-    elif is_dict_like(obj):
-        return dict_map(obj, lambda v: json_encoder(v))
+
+def _encode_unknown(obj):
+    try:
+        return _fallback_encoder.default(obj)
+    except TypeError:
+        logging.debug("Cannot serialize %r of %s", obj, type(obj))
+        return unicode(obj)
+
+
+# (types, handler) pairs in the order in which they are tried
+ENCODERS = [
+    (datetime, lambda obj: obj.isoformat()),
+    (Decimal, str),
+    (unicode, lambda obj: obj),
+    (LIST_LIKE_TYPES, lambda obj: [json_encoder(i) for i in obj]),
+    (DICT_LIKE_TYPES, lambda obj: dict_map(obj, json_encoder)),
+]
+
+# concrete type => handler resolved from ENCODERS
+_handlers = {}
+
+_fallback_encoder = json.JSONEncoder()
+
+
+def register_encoder(types, handler, first=False):
+    if first:
+        ENCODERS.insert(0, (types, handler))
     else:
-        try:
-            return _json.JSONEncoder().default(obj)
-        except Exception as e:
-            current_app.logger.debug("Cannot serialize")
-            current_app.logger.debug(obj)
-            current_app.logger.debug(type(obj))
-            current_app.logger.debug(e)
-            return unicode(obj)
+        ENCODERS.append((types, handler))
+    _handlers.clear()
+
+
+def _handler_for(cls):
+    for types, handler in ENCODERS:
+        if issubclass(cls, types):
+            return handler
+    return _encode_unknown
+
+
+def json_encoder(obj):
+    cls = obj.__class__
+    try:
+        handler = _handlers[cls]
+    except KeyError:
+        handler = _handlers[cls] = _handler_for(cls)
+    return handler(obj)
+
+
+class JSONBackend(object):
+    """
+    Wraps a json module with a single encoder instance which is reused for
+    every call. The encoder holds only its configuration, so the same
+    instance is safe to share across threads.
+    """
+
+    def __init__(self, module, **options):
+        self.module = module
+        self.options = options
+        self.encoder = module.JSONEncoder(default=json_encoder, **options)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # Options like indent need an encoder of their own
+            kwargs.setdefault('default', json_encoder)
+            for name, value in self.options.iteritems():
+                kwargs.setdefault(name, value)
+            return self.module.dumps(obj, **kwargs)
+        return self.encoder.encode(obj)
+
+    def loads(self, string):
+        return self.module.loads(string)
+
+
+BACKENDS = {'json': JSONBackend(json)}
+
+if simplejson is not None:
+    # use_decimal would turn Decimals into json numbers. We send strings.
+    BACKENDS['simplejson'] = JSONBackend(simplejson, use_decimal=False)
+
+backend = BACKENDS['json']
+if simplejson is not None and simplejson.encoder.c_make_encoder is not None:
+    backend = BACKENDS['simplejson']
+
+
+def use_backend(name):
+    global backend
+    backend = BACKENDS[name]
+    return backend
+
+
+def dumps(obj, **kwargs):
+    return backend.dumps(obj, **kwargs)
+
+
+def loads(string):
+    return backend.loads(string)
+
@@ -2,7 +2,15 @@
 
 
 from werkzeug import url_decode
+from werkzeug.http import parse_accept_header
 from threading import Lock
+import re
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 """
 The following class is completely copied from Overholt example
 """
@@ -84,3 +92,177 @@ class SubdomainDispatcher(object):
     def __call__(self, environ, start_response):
         app = self.get_application(environ['HTTP_HOST'])
         return app(environ, start_response)
+
+
+class _ZlibCompressor(object):
+
+    def __init__(self, level, wbits):
+        self.compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data, flush=False):
+        result = self.compressobj.compress(data)
+        if flush:
+            result += self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+        return result
+
+    def finish(self):
+        return self.compressobj.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor(object):
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data, flush=False):
+        result = self.compressor.process(data)
+        if flush:
+            result += self.compressor.flush()
+        return result
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class CompressionMiddleware(object):
+    """Compresses the responses of the wrapped app with the best encoding
+    that the client accepts. Only responses with one of `content_types`
+    and a body of at least `min_size` bytes are compressed. A streamed
+    response, whose size is not known up front, is always compressed and
+    every chunk is flushed out as soon as it is compressed. The body is
+    never buffered as a whole.
+
+    The encoding is appended to the ETag of a compressed response, so that
+    the compressed and plain forms do not share a strong ETag. It is
+    stripped from If-None-Match before the request reaches the app.
+
+    Every response with one of `content_types`, and every 304, varies on
+    Accept-Encoding, whether it was compressed or not, so that caches do
+    not hand a plain body to clients asking for gzip or the other way
+    around.
+    """
+
+    default_content_types = frozenset([
+        'application/json', 'application/javascript', 'application/xml',
+        'text/html', 'text/css', 'text/plain', 'text/javascript',
+        'text/csv'])
+
+    etag_suffix = re.compile(r'-(br|gzip|deflate)"')
+
+    def __init__(self, app, min_size=500, level=6, content_types=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.content_types = frozenset(
+            content_types or self.default_content_types)
+        self.compressors = {
+            'gzip': lambda: _ZlibCompressor(self.level, 16 + zlib.MAX_WBITS),
+            'deflate': lambda: _ZlibCompressor(self.level, zlib.MAX_WBITS)
+        }
+        # In order of preference
+        self.encodings = ['gzip', 'deflate']
+        if brotli is not None:
+            self.compressors['br'] = lambda: _BrotliCompressor(self.level)
+            self.encodings.insert(0, 'br')
+
+    def _add_vary(self, headers):
+        for i, (name, value) in enumerate(headers):
+            if name.lower() == 'vary':
+                varies = [v.strip().lower() for v in value.split(',')]
+                if 'accept-encoding' in varies or '*' in varies:
+                    return headers
+                headers = list(headers)
+                headers[i] = (name, value + ', Accept-Encoding')
+                return headers
+        return list(headers) + [('Vary', 'Accept-Encoding')]
+
+    def _is_compressible(self, headers):
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                return value.partition(';')[0].strip().lower() in (
+                    self.content_types)
+        return False
+
+    def _choose_encoding(self, environ):
+        accepted = parse_accept_header(
+            environ.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding in self.encodings:
+            if accepted.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def _should_compress(self, status, headers):
+        if not status.startswith('200') and not status.startswith('201'):
+            return False
+        content_type = None
+        content_length = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            elif name == 'cache-control' and 'no-transform' in value:
+                return False
+            elif name == 'content-type':
+                content_type = value.partition(';')[0].strip().lower()
+            elif name == 'content-length':
+                content_length = int(value)
+        if content_type not in self.content_types:
+            return False
+        return content_length is None or content_length >= self.min_size
+
+    def __call__(self, environ, start_response):
+        # Whatever the client accepts now, it may hold the ETag of a
+        # compressed form from before
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            environ['HTTP_IF_NONE_MATCH'] = self.etag_suffix.sub(
+                '"', environ['HTTP_IF_NONE_MATCH'])
+        encoding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            encoding = self._choose_encoding(environ)
+
+        state = {}
+
+        def _start_response(status, headers, exc_info=None):
+            if status.startswith('304'):
+                headers = self._add_vary(headers)
+                if encoding is not None:
+                    # The client revalidated the compressed form
+                    headers = [
+                        (name, value[:-1] + '-%s"' % encoding
+                         if name.lower() == 'etag' and value.endswith('"')
+                         else value)
+                        for name, value in headers]
+            elif self._is_compressible(headers):
+                if encoding is not None and self._should_compress(
+                        status, headers):
+                    state['streamed'] = not any(
+                        name.lower() == 'content-length'
+                        for name, v in headers)
+                    state['compressor'] = self.compressors[encoding]()
+                    headers = [
+                        (name, value[:-1] + '-%s"' % encoding
+                         if name.lower() == 'etag' and value.endswith('"')
+                         else value)
+                        for name, value in headers
+                        if name.lower() != 'content-length']
+                    headers.append(('Content-Encoding', encoding))
+                headers = self._add_vary(headers)
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        if 'compressor' not in state:
+            return app_iter
+        return self._compressed(
+            app_iter, state['compressor'], state['streamed'])
+
+    def _compressed(self, app_iter, compressor, streamed):
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    data = compressor.compress(chunk, flush=streamed)
+                    if data:
+                        yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -0,0 +1,710 @@
+"""
+Caches which sit between the models and the db, and the session events
+which keep them fresh.
+"""
+from itertools import chain
+from threading import Lock
+import cPickle as pickle
+from hashlib import md5
+from sqlalchemy import event, inspect, UniqueConstraint
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.attributes import (get_state_history,
+                                       PASSIVE_NO_INITIALIZE)
+from ..utils import LRUCache, is_list_like, is_dict_like
+
+
+def identity_of(obj):
+    """
+    'Class:pk' string of a persistent instance, None for anything else. The
+    base class of the mapper is used, so that all the classes of a
+    polymorphic hierarchy share one namespace like their identity keys do.
+    """
+    try:
+        state = inspect(obj)
+    except Exception:
+        return None
+    if getattr(state, 'identity', None) is None:
+        return None
+    return _identity(state.mapper, state.identity)
+
+
+def _identity(mapper, pk):
+    return '%s:%s' % (mapper.base_mapper.class_.__name__,
+                      ':'.join(str(v) for v in pk))
+
+
+def changed_identities(session):
+    """
+    The identities of all the objects being flushed, along with those of
+    their many-to-one parents (old and new), whose serialized forms may
+    include these objects. The parents are found from the foreign key
+    values, so nothing is loaded from the db. Objects added to or removed
+    from a many-to-many collection are included too, since the rows of the
+    secondary table are their relationships as much as the owner's.
+    """
+    identities = set()
+    for obj in list(session.new) + list(session.dirty) + list(
+            session.deleted):
+        state = inspect(obj)
+        if state.identity is not None:
+            identities.add(_identity(state.mapper, state.identity))
+        for rel in state.mapper.relationships:
+            if rel.secondary is not None:
+                history = get_state_history(
+                    state, rel.key, PASSIVE_NO_INITIALIZE)
+                for other in chain(history.added or (),
+                                   history.deleted or ()):
+                    identity = identity_of(other)
+                    if identity is not None:
+                        identities.add(identity)
+                continue
+            if rel.direction is not MANYTOONE or len(
+                    rel.local_remote_pairs) != 1:
+                continue
+            local_col = rel.local_remote_pairs[0][0]
+            try:
+                prop = state.mapper.get_property_by_column(local_col)
+            except Exception:
+                continue
+            for value in state.attrs[prop.key].history.sum():
+                if value is not None:
+                    identities.add(_identity(rel.mapper, (value,)))
+    return identities
+
+
+class SerializedObjectCache(object):
+    """
+    Caches the dicts built by serialization plans, keyed by the object
+    identity and the plan. Only models with `_cache_serialized_ = True` go
+    through it.
+
+    There are two tiers. An in-process LRU, and optionally a redis store
+    shared by all the processes. Every entry remembers the identities of the
+    objects it was built from (the object itself and everything reachable
+    through the relationships of the plan), so that a commit which touches
+    any of them invalidates the entry.
+
+    The local tier of a process is invalidated only by the commits of that
+    process. Keep `local_ttl` short when more than one process writes.
+    Entries are pickled in both tiers, so every hit is a fresh copy which
+    the caller may change. Dicts built after the transaction has written
+    go to the shared tier only once it commits, and only if it did not
+    write any object they were built from.
+    """
+
+    def __init__(self, maxsize=10000, local_ttl=60, shared_ttl=3600):
+        self.local = LRUCache(maxsize=maxsize, ttl=local_ttl)
+        self.shared = None
+        self.shared_ttl = shared_ttl
+        self.enabled = True
+        # identity => set of local cache keys built from that object
+        self._dependents = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app, redis_store=None):
+        self.enabled = app.config.get('SERIALIZED_CACHE_ENABLED', True)
+        self.local.maxsize = app.config.get(
+            'SERIALIZED_CACHE_SIZE', self.local.maxsize)
+        self.local.ttl = app.config.get(
+            'SERIALIZED_CACHE_LOCAL_TTL', self.local.ttl)
+        self.shared_ttl = app.config.get(
+            'SERIALIZED_CACHE_SHARED_TTL', self.shared_ttl)
+        if app.config.get('SERIALIZED_CACHE_SHARED', False):
+            self.shared = redis_store
+
+    def listen(self, session_cls):
+        event.listen(session_cls, 'after_flush', self._record_flush)
+        event.listen(session_cls, 'after_commit', self._commit_record)
+        event.listen(session_cls, 'after_soft_rollback', self._drop_record)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': len(self.local)
+        }
+
+    def _key(self, plan, identity):
+        return 'serialized:%s:%s' % (identity, plan.cache_id)
+
+    def serialize(self, plan, obj):
+        identity = identity_of(obj)
+        state = inspect(obj)
+        if not self.enabled or identity is None or state.modified:
+            return plan.build(obj)
+        key = self._key(plan, identity)
+        result = self.local.get(key)
+        if result is not None:
+            self.hits += 1
+            return pickle.loads(result[0])
+        if self.shared is not None:
+            pickled = self.shared.get(key)
+            if pickled is not None:
+                self.shared_hits += 1
+                value, dependencies = pickle.loads(pickled)
+                self._set_local(key, pickle.dumps(value, -1), dependencies)
+                return value
+        self.misses += 1
+        value = plan.build(obj)
+        dependencies = set([identity])
+        dependencies.update(plan.reachable_identities(obj))
+        pickled = pickle.dumps(value, -1)
+        self._set_local(key, pickled, dependencies)
+        if self.shared is not None:
+            record = state.session.plus_record if state.session else {}
+            if record.get('serialized_cache_stale'):
+                # Built from uncommitted writes. Other processes must not
+                # see it before the commit.
+                record.setdefault('serialized_cache_pending', []).append(
+                    (key, value, dependencies))
+            else:
+                self._set_shared([(key, value, dependencies)])
+        return pickle.loads(pickled)
+
+    def _set_shared(self, entries):
+        pipe = self.shared.pipeline()
+        for key, value, dependencies in entries:
+            pipe.setex(key, self.shared_ttl,
+                       pickle.dumps((value, dependencies), -1))
+            for dependency in dependencies:
+                pipe.sadd('serialized:deps:%s' % dependency, key)
+                pipe.expire('serialized:deps:%s' % dependency,
+                            self.shared_ttl)
+        pipe.execute()
+
+    def _set_local(self, key, pickled, dependencies):
+        self.local.set(key, (pickled, dependencies))
+        with self._lock:
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(key)
+            if len(self._dependents) > 4 * self.local.maxsize:
+                # Entries evicted from the LRU leave their keys behind here.
+                # Rebuild the index from what is still cached.
+                self._dependents = {}
+                for k, (v, deps) in self.local.items():
+                    for dependency in deps:
+                        self._dependents.setdefault(
+                            dependency, set()).add(k)
+
+    def invalidate(self, identities):
+        identities = list(identities)
+        if len(identities) == 0:
+            return
+        with self._lock:
+            keys = set()
+            for identity in identities:
+                keys.update(self._dependents.pop(identity, ()))
+        for key in keys:
+            self.local.pop(key)
+        self.invalidations += len(keys)
+        if self.shared is not None:
+            dep_keys = ['serialized:deps:%s' % i for i in identities]
+            pipe = self.shared.pipeline()
+            for dep_key in dep_keys:
+                pipe.smembers(dep_key)
+            shared_keys = set()
+            for members in pipe.execute():
+                shared_keys.update(members)
+            self.shared.delete(*(list(shared_keys) + dep_keys))
+
+    def clear(self):
+        with self._lock:
+            self._dependents = {}
+        self.local.clear()
+
+    def _record_flush(self, session, flush_context):
+        session.plus_record.setdefault(
+            'serialized_cache_stale', set()).update(
+            changed_identities(session))
+
+    def _commit_record(self, session):
+        # Releasing a savepoint commits nothing yet. The dicts built since
+        # may still be rolled back along with the transaction.
+        if session.transaction.nested:
+            return
+        stale = session.plus_record.pop('serialized_cache_stale', set())
+        self.invalidate(stale)
+        pending = [
+            (key, value, dependencies) for key, value, dependencies in
+            session.plus_record.pop('serialized_cache_pending', ())
+            if dependencies.isdisjoint(stale)]
+        if self.shared is not None and pending:
+            self._set_shared(pending)
+
+    def _drop_record(self, session, previous_transaction):
+        # Invalidate on rollbacks as well. Dicts built from flushed but
+        # uncommitted state may have been cached in between.
+        if previous_transaction.parent is not None:
+            # A savepoint or a subtransaction. The writes of the transaction
+            # around it are still to be committed or rolled back.
+            self.invalidate(session.plus_record.get(
+                'serialized_cache_stale', ()))
+            return
+        session.plus_record.pop('serialized_cache_pending', None)
+        self.invalidate(session.plus_record.pop(
+            'serialized_cache_stale', ()))
+
+
+serialized_cache = SerializedObjectCache()
+
+
+def statement_key(query):
+    """The sql and the params of a query, and the names of the tables it
+    reads, to key cached results of the query by"""
+    statement = query.statement
+    tables = sorted(set(
+        table.name for table in find_tables(statement, check_columns=True)))
+    compiled = statement.compile()
+    return (unicode(compiled), repr(sorted(compiled.params.items())),
+            tables)
+
+
+class CountCache(object):
+    """
+    Caches the row counts of filtered queries, keyed by their sql and
+    params. The key also holds a version of every table the query reads.
+    A commit which writes to a table bumps its version, so that every
+    count over that table is recomputed, while the stale entries just age
+    out of the LRU. Counts over the tables which the current transaction
+    has written go to the db, and are not cached.
+
+    Versions are per process. Writes from other processes are seen after
+    `ttl` seconds.
+    """
+
+    def __init__(self, maxsize=2000, ttl=300):
+        self.counts = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.table_versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.counts.maxsize = app.config.get(
+            'COUNT_CACHE_SIZE', self.counts.maxsize)
+        self.counts.ttl = app.config.get('COUNT_CACHE_TTL', self.counts.ttl)
+
+    def listen(self, session_cls):
+        event.listen(session_cls, 'after_flush', self._record_flush)
+        event.listen(session_cls, 'after_bulk_update', self._record_bulk)
+        event.listen(session_cls, 'after_bulk_delete', self._record_bulk)
+        event.listen(session_cls, 'after_commit', self._commit_record)
+        event.listen(session_cls, 'after_soft_rollback', self._drop_record)
+
+    def count(self, query):
+        query = query.order_by(None)
+        sql, params, tables = statement_key(query)
+        record = query.session.plus_record
+        if set(tables) & record.get('count_cache_stale', set()):
+            # This transaction has written to these tables
+            return query.count()
+        key = (sql, params,
+               tuple(self.table_versions.get(t, 0) for t in tables))
+        total = self.counts.get(key)
+        if total is not None:
+            self.hits += 1
+            return total
+        self.misses += 1
+        total = query.count()
+        # Unless the count autoflushed writes to these tables
+        if not set(tables) & record.get('count_cache_stale', set()):
+            self.counts.set(key, total)
+        return total
+
+    def invalidate_tables(self, tables):
+        for table in tables:
+            self.table_versions[table] = self.table_versions.get(table, 0) + 1
+
+    def _record_flush(self, session, flush_context):
+        tables = session.plus_record.setdefault('count_cache_stale', set())
+        for obj in list(session.new) + list(session.dirty) + list(
+                session.deleted):
+            tables.update(t.name for t in inspect(obj).mapper.tables)
+
+    def _record_bulk(self, update_context):
+        update_context.session.plus_record.setdefault(
+            'count_cache_stale', set()).update(
+            t.name for t in update_context.mapper.tables)
+
+    def _commit_record(self, session):
+        # Releasing a savepoint commits nothing yet
+        if not session.transaction.nested:
+            self.invalidate_tables(session.plus_record.pop(
+                'count_cache_stale', ()))
+
+    def _drop_record(self, session, previous_transaction):
+        if previous_transaction.parent is None:
+            self.invalidate_tables(session.plus_record.pop(
+                'count_cache_stale', ()))
+
+
+count_cache = CountCache()
+
+
+class LocalBackend(object):
+    """Query result cache backend keeping results in a per process LRU"""
+
+    def __init__(self, maxsize=5000):
+        self.results = LRUCache(maxsize=maxsize)
+        self.table_versions = {}
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def set(self, key, value, ttl):
+        self.results.set(key, value, ttl=ttl)
+
+    def versions(self, tables):
+        return [self.table_versions.get(t, 0) for t in tables]
+
+    def bump(self, tables):
+        for table in tables:
+            self.table_versions[table] = self.table_versions.get(table, 0) + 1
+
+
+class RedisBackend(object):
+    """
+    Query result cache backend shared by all the processes through redis.
+    The table versions live in redis as well, so a commit in any process
+    invalidates the results of every other.
+    """
+
+    def __init__(self, redis, prefix='querycache:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def get(self, key):
+        pickled = self.redis.get(self.prefix + key)
+        return pickle.loads(pickled) if pickled is not None else None
+
+    def set(self, key, value, ttl):
+        self.redis.setex(self.prefix + key, ttl, pickle.dumps(value, -1))
+
+    def versions(self, tables):
+        if len(tables) == 0:
+            return []
+        return [int(v or 0) for v in self.redis.mget(
+            [self.prefix + 'version:' + t for t in tables])]
+
+    def bump(self, tables):
+        pipe = self.redis.pipeline()
+        for table in tables:
+            pipe.incr(self.prefix + 'version:' + table)
+        pipe.execute()
+
+
+class QueryResultCache(object):
+    """
+    Caches the results of queries marked with `QueryPlus.cached`, keyed by
+    their sql, params and the versions of the tables they read. Every
+    commit bumps the versions of the tables it wrote in all the regions.
+    Queries over the tables which the current transaction has written go
+    to the db, and are not cached.
+
+    Regions name backends. 'default' is a LocalBackend, and init_app adds
+    a 'redis' region over the redis store of the app.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.enabled = True
+        self.regions = {'default': LocalBackend()}
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app, redis_store=None):
+        self.enabled = app.config.get('QUERY_CACHE_ENABLED', True)
+        self.ttl = app.config.get('QUERY_CACHE_TTL', self.ttl)
+        if redis_store is not None:
+            self.add_region('redis', RedisBackend(redis_store))
+
+    def add_region(self, name, backend):
+        self.regions[name] = backend
+
+    def listen(self, session_cls):
+        event.listen(session_cls, 'after_flush', self._record_flush)
+        event.listen(session_cls, 'after_bulk_update', self._record_bulk)
+        event.listen(session_cls, 'after_bulk_delete', self._record_bulk)
+        event.listen(session_cls, 'after_commit', self._commit_record)
+        event.listen(session_cls, 'after_soft_rollback', self._drop_record)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def fetch(self, query, load, ttl=None, region='default'):
+        """
+        Returns the cached result of `query`, or caches and returns what
+        `load` returns. The result has to be picklable for shared regions.
+        """
+        backend = self.regions[region]
+        sql, params, tables = statement_key(query)
+        record = query.session.plus_record
+        if set(tables) & record.get('query_cache_stale', set()):
+            # This transaction has written to these tables
+            return load()
+        key = md5(repr((sql, params, backend.versions(tables)))).hexdigest()
+        result = backend.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = load()
+        # Unless the load autoflushed writes to these tables
+        if not set(tables) & record.get('query_cache_stale', set()):
+            backend.set(key, result, ttl or self.ttl)
+        return result
+
+    def invalidate_tables(self, tables):
+        tables = list(tables)
+        if len(tables) == 0:
+            return
+        for backend in self.regions.values():
+            backend.bump(tables)
+
+    def _record_flush(self, session, flush_context):
+        tables = session.plus_record.setdefault('query_cache_stale', set())
+        for obj in chain(session.new, session.dirty, session.deleted):
+            tables.update(t.name for t in inspect(obj).mapper.tables)
+
+    def _record_bulk(self, update_context):
+        update_context.session.plus_record.setdefault(
+            'query_cache_stale', set()).update(
+            t.name for t in update_context.mapper.tables)
+
+    def _commit_record(self, session):
+        # Releasing a savepoint commits nothing yet. The tables it wrote
+        # stay stale until the transaction commits or rolls back.
+        if not session.transaction.nested:
+            self.invalidate_tables(
+                session.plus_record.pop('query_cache_stale', ()))
+
+    def _drop_record(self, session, previous_transaction):
+        # Invalidate on rollbacks as well, in case results of the written
+        # tables were cached by another session in between
+        if previous_transaction.parent is None:
+            self.invalidate_tables(
+                session.plus_record.pop('query_cache_stale', ()))
+
+
+query_cache = QueryResultCache()
+
+
+class LookupMemo(object):
+    """
+    Remembers the results of unique key lookups, like `User.first(api_key=
+    ...)`, for the life of a transaction of a session. The memo lives on
+    the session, keyed by (class, criteria), and only holds lookups which
+    found a row by criteria covering the primary key, a unique column or a
+    unique constraint of the class, so a hit is the row the query would
+    have returned. Lookups which found nothing are not remembered, since
+    the row may be added by then.
+
+    A flush drops the entries of the classes it wrote, bulk updates and
+    deletes drop everything, and so do commits and rollbacks. An entry
+    whose object has left the session, or is to be deleted, is dropped
+    when it is looked up. Lookups of a class with new objects, or with
+    changes to the attributes of its unique keys, waiting to be flushed
+    skip the memo, so that they autoflush like before. Those classes are
+    noted as the changes happen, so the check costs the same however
+    large the session is. A memo which grows past `maxsize` entries starts
+    over.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.enabled = True
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # class => list of sets of column attribute names which are unique
+        self._unique_keys = {}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('LOOKUP_MEMO_ENABLED', True)
+        self.maxsize = app.config.get('LOOKUP_MEMO_SIZE', self.maxsize)
+
+    def listen(self, session_cls):
+        event.listen(session_cls, 'after_flush', self._record_flush)
+        event.listen(session_cls, 'after_flush_postexec',
+                     self._clear_pending)
+        event.listen(session_cls, 'after_attach', self._record_attach)
+        event.listen(session_cls, 'after_bulk_update', self._clear_bulk)
+        event.listen(session_cls, 'after_bulk_delete', self._clear_bulk)
+        event.listen(session_cls, 'after_commit', self._clear)
+        event.listen(session_cls, 'after_soft_rollback', self._clear)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def saved(self, session):
+        """Number of queries the memo saved in this session"""
+        return session.plus_record.get('lookup_memo_hits', 0)
+
+    def unique_keys(self, cls):
+        keys = self._unique_keys.get(cls)
+        if keys is None:
+            mapper = inspect(cls)
+            names = {}
+            for prop in mapper.column_attrs:
+                for column in prop.columns:
+                    names[column] = prop.key
+            column_sets = [mapper.primary_key]
+            for table in mapper.tables:
+                column_sets.extend([c] for c in table.columns if c.unique)
+                column_sets.extend(
+                    c.columns for c in table.constraints
+                    if isinstance(c, UniqueConstraint))
+                column_sets.extend(
+                    i.columns for i in table.indexes if i.unique)
+            keys = [set(names.get(c) for c in columns)
+                    for columns in column_sets]
+            keys = [k for k in keys if None not in k]
+            # Changes which can make a lookup find another row, or none
+            key_columns = set(
+                c for columns in column_sets for c in columns)
+            attrs = set(chain(*keys))
+            attrs.update(
+                rel.key for rel in mapper.relationships
+                if rel.direction is MANYTOONE and any(
+                    c in key_columns for c, r in rel.local_remote_pairs))
+            for name in attrs:
+                event.listen(getattr(cls, name), 'set', self._record_set,
+                             propagate=True)
+            self._unique_keys[cls] = keys
+        return keys
+
+    def lookup(self, cls, criteria, loader):
+        """
+        Returns the memoized result of looking up `cls` by the dict of
+        `criteria`, calling `loader` on a miss. Criteria which are not
+        unique, or not hashable, go straight to `loader`.
+        """
+        session = cls.session()
+        if (not self.enabled or len(criteria) == 0 or
+                not any(k <= set(criteria) for k in self.unique_keys(cls))):
+            return loader()
+        try:
+            key = (cls, frozenset(criteria.items()))
+            hash(key)
+        except TypeError:
+            return loader()
+        if cls in session.plus_record.get('lookup_memo_pending', ()):
+            return loader()
+        memo = session.plus_record.setdefault('lookup_memo', {})
+        result = memo.get(key)
+        if result is not None:
+            if result in session and inspect(result) not in session._deleted:
+                self.hits += 1
+                session.plus_record['lookup_memo_hits'] = (
+                    self.saved(session) + 1)
+                return result
+            # Expunged or deleted since
+            del memo[key]
+        self.misses += 1
+        result = loader()
+        if result is not None:
+            if len(memo) >= self.maxsize:
+                memo.clear()
+            memo[key] = result
+        return result
+
+    def invalidate_tables(self, session, tables):
+        memo = session.plus_record.get('lookup_memo')
+        if not memo:
+            return
+        tables = set(tables)
+        for key in list(memo.keys()):
+            if tables & set(t.name for t in inspect(key[0]).tables):
+                del memo[key]
+
+    def _record_flush(self, session, flush_context):
+        tables = set()
+        for obj in chain(session.new, session.dirty, session.deleted):
+            tables.update(t.name for t in inspect(obj).mapper.tables)
+        self.invalidate_tables(session, tables)
+
+    def _mark_pending(self, session, obj):
+        session.plus_record.setdefault('lookup_memo_pending', set()).update(
+            obj.__class__.__mro__)
+
+    def _record_attach(self, session, obj):
+        if inspect(obj).key is None:
+            self._mark_pending(session, obj)
+
+    def _record_set(self, target, value, oldvalue, initiator):
+        session = object_session(target)
+        if session is not None and hasattr(session, 'plus_record'):
+            self._mark_pending(session, target)
+
+    def _clear_pending(self, session, flush_context):
+        session.plus_record.pop('lookup_memo_pending', None)
+
+    def _clear_bulk(self, update_context):
+        update_context.session.plus_record.pop('lookup_memo', None)
+
+    def _clear(self, session, *args):
+        session.plus_record.pop('lookup_memo', None)
+        session.plus_record.pop('lookup_memo_pending', None)
+
+
+lookup_memo = LookupMemo()
+
+
+def record_bulk_write(session, cls, pks=()):
+    """
+    Tells the caches about a write to `cls` which went around the unit of
+    work, like a bulk insert or an UPDATE through the query api, so that
+    they are invalidated when the transaction ends, like after a flush.
+    `pks` are the primary keys of the existing rows written to.
+    """
+    mapper = inspect(cls)
+    tables = set(t.name for t in mapper.tables)
+    record = session.plus_record
+    record.setdefault('count_cache_stale', set()).update(tables)
+    record.setdefault('query_cache_stale', set()).update(tables)
+    record.setdefault('serialized_cache_stale', set()).update(
+        _identity(mapper, (pk,)) for pk in pks)
+    lookup_memo.invalidate_tables(session, tables)
+
+
+def estimated_count(query):
+    """
+    A cheap estimate of the row count of a query from the statistics of
+    the db, without scanning the rows. Uses the row estimate of EXPLAIN on
+    mysql and postgresql, and the table row count collected by ANALYZE on
+    sqlite. Returns None when the db has no estimate to offer.
+    """
+    connection = query.session.connection()
+    dialect = connection.dialect
+    compiled = query.order_by(None).statement.compile(dialect=dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+    try:
+        if dialect.name == 'mysql':
+            row = connection.execute(
+                'EXPLAIN ' + unicode(compiled), params).first()
+            return int(row['rows']) if row is not None else None
+        elif dialect.name == 'postgresql':
+            plan = connection.execute(
+                'EXPLAIN (FORMAT JSON) ' + unicode(compiled),
+                params).scalar()
+            return int(plan[0]['Plan']['Plan Rows'])
+        elif dialect.name == 'sqlite':
+            # sqlite keeps no estimates for filtered queries. The row count
+            # of the table from ANALYZE is the closest it has.
+            stat = connection.execute(
+                'SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1',
+                [query.cls.__table__.name]).scalar()
+            return int(stat.split()[0]) if stat else None
+    except DBAPIError:
+        return None
+    return None
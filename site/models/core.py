@@ -2,16 +2,158 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_sqlalchemy import (
     SignallingSession,
     _QueryProperty, _BoundDeclarativeMeta)
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql.expression import SelectBase, TextClause
+from itertools import cycle
+from time import time
+import re
+from ..utils import OrderedIdentitySet
 from .modelbase import ModelBase, QueryPlus
+from .caching import serialized_cache, count_cache, lookup_memo, query_cache
+from .instrumentation import sql_instrumentation
+from ..webhooks import webhooks
+
+
+# Name of the bind of the nth replica in SQLALCHEMY_BINDS
+REPLICA_BIND = '__replica_%d__'
+
+
+_TEXT_READ = re.compile(r'^\s*(select|show|explain|describe)\b', re.I)
+_TEXT_LOCK = re.compile(r'\b(for\s+update|lock\s+in\s+share\s+mode)\b', re.I)
+
+
+def _is_read(clause):
+    if isinstance(clause, TextClause):
+        return (_TEXT_READ.match(clause.text) is not None and
+                _TEXT_LOCK.search(clause.text) is None)
+    return (isinstance(clause, SelectBase) and
+            getattr(clause, '_for_update_arg', None) is None)
 
 
 class SignallingSessionPlus(SignallingSession):
     def __init__(self, db, autocommit=False, autoflush=True, **options):
         super(SignallingSessionPlus, self).__init__(
             db, autocommit, autoflush, **options)
+        self.db = db
         self.plus_record = {}
 
+    def record(self, key, item, unique=True):
+        """
+        Records `item` under `key` as work for the commit of this session.
+        Unique records are sets of objects, others lists of events. The
+        records are dropped when the transaction commits or rolls back. The
+        rollback of a savepoint drops only those recorded since it began.
+        """
+        changes = self.plus_record.setdefault('changes', {})
+        if unique:
+            changes.setdefault(key, OrderedIdentitySet()).add(item)
+        else:
+            changes.setdefault(key, []).append(item)
+
+    def recorded(self, key):
+        """What is recorded under `key`, None if nothing is"""
+        return self.plus_record.get('changes', {}).get(key)
+
+    def pop_record(self, key):
+        """What is recorded under `key`, which is not recorded anymore"""
+        return self.plus_record.get('changes', {}).pop(key, None) or []
+
+    def use_primary(self):
+        """Sends every later statement of the current transaction of this
+        session to the primary"""
+        self.plus_record['use_primary'] = True
+
+    def get_bind(self, mapper=None, clause=None):
+        """Reads go to a replica, if there are any, until the transaction
+        writes, has changes waiting to be flushed, or is told to use the
+        primary. Everything else goes to the primary. Raw sql counts as a
+        read when it is a SELECT without a lock.
+
+        A commit which wrote keeps the reads on the primary for another
+        SQLALCHEMY_REPLICA_LAG seconds, so that they see what it wrote.
+        """
+        if _is_read(clause):
+            if (not self.plus_record.get('use_primary') and
+                    self.plus_record.get('primary_until', 0) <= time() and
+                    not self._flushing and self._is_clean() and (
+                        mapper is None or
+                        mapper.mapped_table.info.get('bind_key') is None)):
+                replica = self.db.next_replica(self.app)
+                if replica is not None:
+                    return replica
+        elif clause is not None:
+            # An insert, update or delete outside of a flush
+            self.use_primary()
+        return super(SignallingSessionPlus, self).get_bind(mapper, clause)
+
+
+serialized_cache.listen(SignallingSessionPlus)
+count_cache.listen(SignallingSessionPlus)
+lookup_memo.listen(SignallingSessionPlus)
+query_cache.listen(SignallingSessionPlus)
+webhooks.listen(SignallingSessionPlus)
+
+
+@event.listens_for(SignallingSessionPlus, 'after_transaction_create')
+def save_changes(session, transaction):
+    # What the rollback of a savepoint takes the changes back to
+    if transaction.nested:
+        session.plus_record.setdefault('savepoints', {})[transaction] = dict(
+            (key, type(items)(items)) for key, items
+            in session.plus_record.get('changes', {}).iteritems())
+
+
+# After the listeners above, which take what they need from the changes
+@event.listens_for(SignallingSessionPlus, 'after_commit')
+def clear_changes(session):
+    # Releasing a savepoint commits nothing yet
+    if session.transaction.nested:
+        session.plus_record.get('savepoints', {}).pop(
+            session.transaction, None)
+        return
+    session.plus_record.pop('changes', None)
+    session.plus_record.pop('savepoints', None)
+
+
+@event.listens_for(SignallingSessionPlus, 'after_soft_rollback')
+def restore_changes(session, previous_transaction):
+    # The rollback of a subtransaction rolls back the savepoint or the
+    # transaction around it
+    transaction = previous_transaction
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    if transaction.parent is None:
+        session.plus_record.pop('changes', None)
+        session.plus_record.pop('savepoints', None)
+        return
+    changes = session.plus_record.get('savepoints', {}).pop(transaction, None)
+    if changes is not None:
+        session.plus_record['changes'] = changes
+
+
+@event.listens_for(SignallingSessionPlus, 'after_flush')
+def stick_to_primary(session, flush_context):
+    # Replicas lag behind, so read the writes back from the primary
+    session.use_primary()
+
+
+@event.listens_for(SignallingSessionPlus, 'after_commit')
+def unstick_after_commit(session):
+    # Releasing a savepoint leaves the transaction and its writes open
+    if session.transaction.nested:
+        return
+    if session.plus_record.pop('use_primary', None):
+        session.plus_record['primary_until'] = time() + (
+            session.app.config.get('SQLALCHEMY_REPLICA_LAG', 1))
+
+
+@event.listens_for(SignallingSessionPlus, 'after_soft_rollback')
+def unstick_after_rollback(session, previous_transaction):
+    # A savepoint leaves the writes of the transaction around it
+    if previous_transaction.parent is None:
+        session.plus_record.pop('use_primary', None)
+
 
 class QueryPropertyPlus(_QueryProperty):
 
@@ -30,6 +172,38 @@ class SQLAlchemyPlus(SQLAlchemy):
     def __init__(self, **kwargs):
         super(SQLAlchemyPlus, self).__init__(**kwargs)
         self.Query = QueryPlus
+        # app => cycle over the names of its replica binds
+        self._replicas = {}
+
+    def init_app(self, app):
+        """Registers the uris in SQLALCHEMY_REPLICA_URIS as binds, which
+        the sessions read from round robin. Two sqlite files will do for a
+        local primary and replica.
+        """
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        if uris:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            for i, uri in enumerate(uris):
+                binds[REPLICA_BIND % i] = uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+            self._replicas[app] = cycle(
+                [REPLICA_BIND % i for i in range(len(uris))])
+        super(SQLAlchemyPlus, self).init_app(app)
+        sql_instrumentation.init_app(app)
+
+    def next_replica(self, app):
+        """The engine of the next replica of the app, None without any"""
+        replicas = self._replicas.get(app)
+        if replicas is None:
+            return None
+        return self.get_engine(app, bind=next(replicas))
+
+    def use_primary(self):
+        """Sends the rest of the current transaction to the primary. For
+        views which have to read what was just written elsewhere, or what
+        they committed themselves.
+        """
+        self.session().use_primary()
 
     def make_declarative_base(self):
         """Creates the declarative base."""
@@ -0,0 +1,210 @@
+"""
+Counts and times the sql statements run per request, and points out the
+statement shapes which repeat with different params, the usual sign of
+an N+1, like lazy loads inside `todict`.
+"""
+import re
+import logging
+from hashlib import md5
+from time import time
+from threading import local
+from contextlib import contextmanager
+from flask import g, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from ..json_plus import dumps
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM_LISTS = re.compile(r"\((?:\s*(?:\?|%s|:\w+|%\(\w+\)s)\s*,?)+\)")
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_sql(statement):
+    """
+    The shape of a statement. Literals become ?, lists of params become a
+    single (?) and whitespace is collapsed, so that the statements which
+    differ only by their values share a shape.
+    """
+    shape = _LITERALS.sub('?', statement)
+    shape = _PARAM_LISTS.sub('(?)', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+class QueryRecord(object):
+    """
+    The statements run while a record is active. Only the first
+    `max_statements` statements are kept as they are. Each shape keeps a
+    count, a duration and the hash of its first params, so the size of a
+    record does not grow with the number of statements.
+    """
+
+    def __init__(self, max_statements=100):
+        self.count = 0
+        self.duration = 0.0
+        self.max_statements = max_statements
+        self.statements = []
+        # shape => [count, duration, hash of the first params, whether
+        # later params differed]
+        self.shapes = {}
+
+    def add(self, statement, parameters, duration):
+        self.count += 1
+        self.duration += duration
+        if len(self.statements) < self.max_statements:
+            self.statements.append(statement)
+        params_hash = md5(repr(parameters)).digest()
+        shape = self.shapes.get(normalize_sql(statement))
+        if shape is None:
+            self.shapes[normalize_sql(statement)] = [
+                1, duration, params_hash, False]
+            return
+        shape[0] += 1
+        shape[1] += duration
+        if params_hash != shape[2]:
+            shape[3] = True
+
+    def repeated(self, threshold=5):
+        """
+        The shapes run at least `threshold` times with different params,
+        as (shape, count, duration) with the most frequent first
+        """
+        return sorted(
+            [(sql, count, duration)
+             for sql, (count, duration, first_params, varied)
+             in self.shapes.iteritems()
+             if count >= threshold and varied],
+            key=lambda r: -r[1])
+
+    def summary(self, threshold=5):
+        return {
+            'queries': self.count,
+            'db_ms': round(self.duration * 1000, 2),
+            'n_plus_one': [
+                {'sql': sql, 'count': count,
+                 'db_ms': round(duration * 1000, 2)}
+                for sql, count, duration in self.repeated(threshold)]
+        }
+
+
+class SQLInstrumentation(object):
+    """
+    Hooks the cursor executions of every engine and adds each statement to
+    all the records active in the thread. A record covers every request
+    when the app is set up with `init_app`. `record()` covers a block.
+
+    The totals of a request go out in a structured log line, at WARNING
+    level when it has likely N+1s. In debug, the Server-Timing and
+    X-DB-Queries headers carry them as well. The totals of a streamed
+    response are logged once it has been sent, so that they include the
+    statements run while its body was generated, and go out without the
+    headers, which are sent first.
+
+    Requests are recorded in debug only, unless SQL_INSTRUMENTATION says
+    otherwise.
+    """
+
+    def __init__(self, app=None):
+        self._local = local()
+        self._listening = False
+        self.threshold = 5
+        self.max_statements = 100
+        self.logger = logging.getLogger(__name__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('SQL_INSTRUMENTATION', app.debug):
+            return
+        self.threshold = app.config.get(
+            'SQL_N_PLUS_ONE_THRESHOLD', self.threshold)
+        self.max_statements = app.config.get(
+            'SQL_MAX_STATEMENTS', self.max_statements)
+        self.listen()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def listen(self):
+        if self._listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        self._listening = True
+
+    @property
+    def active(self):
+        if not hasattr(self._local, 'records'):
+            self._local.records = []
+        return self._local.records
+
+    @contextmanager
+    def record(self):
+        """Records the statements run within the block"""
+        self.listen()
+        query_record = QueryRecord(self.max_statements)
+        self.active.append(query_record)
+        try:
+            yield query_record
+        finally:
+            self.active.remove(query_record)
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        # On the context rather than the connection, so a statement which
+        # fails, and never gets to _after_execute, leaves nothing behind
+        if self.active and context is not None:
+            context._query_start_time = time()
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        if not self.active:
+            return
+        start = getattr(context, '_query_start_time', None)
+        duration = time() - start if start is not None else 0.0
+        for query_record in self.active:
+            query_record.add(statement, parameters, duration)
+
+    def _start_request(self):
+        g.sql_record = QueryRecord(self.max_statements)
+        self.active.append(g.sql_record)
+
+    def _finish_request(self, response):
+        query_record = getattr(g, 'sql_record', None)
+        if query_record is None:
+            return response
+        if response.is_streamed:
+            # The body has not been generated yet. Log at the teardown.
+            g.sql_record_streamed = True
+            return response
+        self._log(query_record)
+        if current_app.debug:
+            response.headers['X-DB-Queries'] = str(query_record.count)
+            response.headers.add(
+                'Server-Timing', 'db;dur=%.2f;desc="%d queries"' % (
+                    query_record.duration * 1000, query_record.count))
+        return response
+
+    def _teardown_request(self, exc=None):
+        query_record = getattr(g, 'sql_record', None)
+        if query_record is not None:
+            del g.sql_record
+            if query_record in self.active:
+                self.active.remove(query_record)
+            if getattr(g, 'sql_record_streamed', False):
+                self._log(query_record)
+
+    def _log(self, query_record):
+        summary = self.summary(query_record)
+        if summary['n_plus_one']:
+            self.logger.warning(dumps(summary))
+        else:
+            self.logger.debug(dumps(summary))
+
+    def summary(self, query_record):
+        summary = query_record.summary(self.threshold)
+        summary['method'] = request.method
+        summary['path'] = request.path
+        return summary
+
+
+sql_instrumentation = SQLInstrumentation()
@@ -1,39 +1,202 @@
-from sqlalchemy import event
+import logging
+from sqlalchemy import event, inspect, orm, func, case, and_
+from sqlalchemy.orm import aliased, object_session
+from sqlalchemy.ext.associationproxy import AssociationProxy
+from collections import namedtuple
 
-from flask import g
-from .core import SignallingSessionPlus as Session
+from .core import SignallingSessionPlus as Session, db
 from flask.signals import Namespace
-from ..utils import (set_if_absent_and_get, append_if_absent, flatten,
-                     ist_now)
+from ..utils import flatten, ist_now
 from decimal import Decimal
+from ..webhooks import webhooks
+from .caching import record_bulk_write
+from .modelbase import IN_BATCH_SIZE, LIST_RELATIONSHIP_LOADER
 
 db_signals = Namespace()
 out_of_stock = db_signals.signal('out_of_stock')
 shipment_status_change = db_signals.signal('shipment_status_change')
 customer_init = db_signals.signal('customer_init')
 
+logger = logging.getLogger(__name__)
+
 
 def all_subclasses(cls):
     return cls.__subclasses__() + [
         g for s in cls.__subclasses__() for g in all_subclasses(s)]
 
 
-def add_to_record(key, item, struct=g):
-    append_if_absent(set_if_absent_and_get(struct, key, []), item)
+def session_of(obj):
+    """The session which records the changes of `obj`. Objects which are
+    not in one yet, like those being constructed, record into the current
+    session, in requests, celery tasks and scripts alike."""
+    return object_session(obj) or db.session()
+
+
+def add_to_record(key, item, obj=None, unique=True):
+    """Records `item` for the commit of the session of `obj`, or of
+    `item` itself"""
+    session_of(item if obj is None else obj).record(key, item, unique=unique)
+
+
+def deliver_claim_redemption(claim_id):
+    # Runs on a webhook worker, after the redemption has been committed
+    post_claim_redemption(Claim.get(claim_id))
+
+
+# What a change of shipment status does. `keep_old` refuses the change and
+# keeps the old status. `to_be_shipped` and `stock` are the changes to the
+# to_be_shipped and stock_in_inventory of the skus in the shipment, in
+# units of their quantity in it. `records` are the commit time records to
+# add the shipment to, or with 'un', to take it out of.
+StatusEffect = namedtuple(
+    'StatusEffect', ['keep_old', 'to_be_shipped', 'stock', 'records'])
+
+NO_EFFECT = StatusEffect(False, 0, 0, ())
+KEEP_OLD = StatusEffect(True, 0, 0, ())
+
+QUEUED_STATUSES = ('in-queue', 'packed')
+MOVING_STATUSES = ('dispatched', 'in-transit')
+SHIPPED_STATUSES = MOVING_STATUSES + ('delivered', 'returned')
+
+# Effect of changing to a status from any old status not in the table below
+DEFAULT_STATUS_EFFECTS = {
+    'delivered': StatusEffect(False, 0, 0, ('delivered',)),
+    'cancelled': StatusEffect(False, -1, 0, ()),
+    'returned': KEEP_OLD
+}
+
+
+def _status_transitions():
+    transitions = {('cancelled', 'cancelled'): NO_EFFECT}
+    for new in QUEUED_STATUSES:
+        transitions[('cancelled', new)] = StatusEffect(False, 1, 0, ())
+        for old in MOVING_STATUSES:
+            transitions[(old, new)] = StatusEffect(False, 1, 1, ())
+        transitions[('delivered', new)] = StatusEffect(
+            False, 1, 1, ('undelivered',))
+        # Taking back a return takes its stock back, and the shipment
+        # goes back into the queue with it
+        transitions[('returned', new)] = StatusEffect(
+            False, 1, 0, ('unreturned',))
+    for new in MOVING_STATUSES:
+        transitions[('cancelled', new)] = KEEP_OLD
+        for old in QUEUED_STATUSES:
+            transitions[(old, new)] = StatusEffect(False, -1, -1, ())
+        transitions[('delivered', new)] = StatusEffect(
+            False, 0, 0, ('undelivered',))
+        transitions[('returned', new)] = StatusEffect(
+            False, 0, -1, ('unreturned',))
+    transitions[('cancelled', 'delivered')] = KEEP_OLD
+    for old in QUEUED_STATUSES:
+        transitions[(old, 'delivered')] = StatusEffect(
+            False, -1, -1, ('delivered',))
+    transitions[('returned', 'delivered')] = StatusEffect(
+        False, 0, -1, ('unreturned', 'delivered'))
+    for old in SHIPPED_STATUSES:
+        transitions[(old, 'cancelled')] = KEEP_OLD
+    for old in MOVING_STATUSES + ('delivered',):
+        transitions[(old, 'returned')] = StatusEffect(
+            False, 0, 1, ('returned',))
+    return transitions
+
+
+STATUS_TRANSITIONS = _status_transitions()
+
+# The records do_before_commit processes, and how many times it goes over
+# them for the records added while processing them
+COMMIT_RECORDS = (
+    'shipment_sku_deltas', 'shipment_deductions', 'shipment_refunds',
+    'ready_to_process', 'shipments_delivered', 'claims_redeemed',
+    'skus_to_be_shipped', 'status_changed_shipments', 'shipments_returned',
+    'out_of_stock')
+MAX_COMMIT_PASSES = 10
+
+
+def _available_stock(sku):
+    # available_stock is computed in sql when it is a hybrid
+    available_stock = getattr(sku, 'available_stock')
+    if hasattr(available_stock, '__clause_element__'):
+        return available_stock
+    return sku.stock_in_inventory - sku.to_be_shipped
+
+
+def check_available_stock(sku_cls):
+    """Checks that the sql fallback of `_available_stock` gives what the
+    available_stock property of `sku_cls` does, so that the campaigns it
+    deactivates are the ones which are really sold out. Logs an error and
+    returns False where they differ."""
+    if hasattr(sku_cls.available_stock, '__clause_element__'):
+        return True
+    for stock_in_inventory, to_be_shipped in ((7, 3), (3, 3), (2, 5)):
+        # Not constructed, so that no init or set listener sees it
+        sku = sku_cls.__mapper__.class_manager.new_instance()
+        sku.stock_in_inventory = stock_in_inventory
+        sku.to_be_shipped = to_be_shipped
+        if sku.available_stock != _available_stock(sku):
+            logger.error(
+                "%s.available_stock is %r with %r in stock and %r to be "
+                "shipped, where the query expects %r", sku_cls.__name__,
+                sku.available_stock, stock_in_inventory, to_be_shipped,
+                _available_stock(sku))
+            return False
+    return True
+
+
+def _load_collection(session, objs, name):
+    """Loads the collection `name` of all the persistent `objs` which have
+    it, and have not loaded it yet, with one query per class and batch"""
+    ids_by_class = {}
+    for obj in objs:
+        state = inspect(obj)
+        if (state.identity is not None and name in state.unloaded and
+                name in state.mapper.relationships):
+            ids_by_class.setdefault(obj.__class__, []).append(
+                state.identity[0])
+    for cls, ids in ids_by_class.iteritems():
+        pk = cls.__mapper__.primary_key[0]
+        for i in range(0, len(ids), IN_BATCH_SIZE):
+            session.query(cls).filter(
+                pk.in_(ids[i:i+IN_BATCH_SIZE])).options(
+                getattr(orm, LIST_RELATIONSHIP_LOADER)(
+                    getattr(cls, name))).all()
+
+
+def _join_path(query, cls, name, target):
+    """Joins `target` to the query through `cls.name`, which may be an
+    association proxy"""
+    attr = getattr(cls, name)
+    if isinstance(attr, AssociationProxy):
+        collection = getattr(cls, attr.target_collection)
+        through = aliased(collection.property.mapper.class_)
+        return query.join(through, collection).join(
+            target, getattr(through, attr.value_attr))
+    return query.join(target, attr)
+
+
+def shipment_status_effect(oldstatus, status):
+    return STATUS_TRANSITIONS.get(
+        (str(oldstatus).lower(), status),
+        DEFAULT_STATUS_EFFECTS.get(status, NO_EFFECT))
 
 
 class EventListener:
+    # How many times do_before_commit processes the records before giving
+    # up on a commit, set by COMMIT_RECORD_PASSES
+    max_commit_passes = MAX_COMMIT_PASSES
 
     def __init__(self, app=None):
         self.app = app
         if app:
-            self.initialize_listeners()
+            self.init_app(app)
 
     def init_app(self, app):
         self.app = app
+        self.max_commit_passes = app.config.get(
+            'COMMIT_RECORD_PASSES', self.max_commit_passes)
         self.initialize_listeners()
 
     def initialize_listeners(self):
+        check_available_stock(SKU)
         event.listen(Shipment.status, 'set', self.on_shipment_status_change,
                      retval=True)
         event.listen(
@@ -101,88 +264,140 @@ class EventListener:
     #     if revoked:
     #         add_to_record('claims_revoked', claim)
 
-    def _reverse_return(self, shipment):
-        if 'shipments_returned' in g and shipment in g.shipments_returned:
-            g.shipments_returned.remove(shipment)
-        for item in shipment.contents:
-                item.sku.stock_in_inventory -= item.quantity
-
-    # Here Be Dragons
     def on_shipment_status_change(self, shipment, status,
                                   oldstatus, initiator):
-        """
-        Dont ask!
-        This should have been implemented as a state flow. Will
-        clean up and implement later.
-        """
-        add_to_record('status_changed_shipments', shipment)
+        session = session_of(shipment)
+        session.record('status_changed_shipments', shipment)
         if status in Shipment.INTERNAL_STATUSES:
             return status
         if status not in (Shipment.ALLOWED_STATUSES):
             raise Exception("Invalid status string")
-        if status == 'in-queue' or status == 'packed':
-            if str(oldstatus).lower() == 'cancelled':
-                for item in shipment.contents:
-                    item.sku.to_be_shipped += item.quantity
-            elif str(oldstatus).lower() in [
-                    'dispatched', 'in-transit', 'delivered', 'returned']:
-                if str(oldstatus).lower() == 'returned':
-                    self._reverse_return(shipment)
-                elif str(oldstatus) == 'delivered':
-                    if ('shipments_delivered' in g and
-                            shipment in g.shipments_delivered):
-                        g.shipments_delivered.remove(shipment)
-                for item in shipment.contents:
-                    item.sku.to_be_shipped += item.quantity
-                    item.sku.stock_in_inventory += item.quantity
-        elif (status == 'in-transit' or status == 'dispatched'):
-            if str(oldstatus).lower() == 'cancelled':
-                status = 'cancelled'
-                return status
-            elif str(oldstatus).lower() in ['in-queue', 'packed']:
-                for item in shipment.contents:
-                    item.sku.to_be_shipped -= item.quantity
-                    item.sku.stock_in_inventory -= item.quantity
-            elif str(oldstatus) == 'delivered':
-                if ('shipments_delivered' in g and
-                        shipment in g.shipments_delivered):
-                    g.shipments_delivered.remove(shipment)
-            elif str(oldstatus).lower() == 'returned':
-                self._reverse_return(shipment)           
-        elif status == 'delivered':
-            if str(oldstatus).lower() == 'cancelled':
-                status = 'cancelled'
-                return status
-            elif str(oldstatus).lower() in ['in-queue', 'packed']:
-                for item in shipment.contents:
-                    item.sku.to_be_shipped -= item.quantity
-                    item.sku.stock_in_inventory -= item.quantity
-            elif str(oldstatus).lower() == 'returned':
-                self._reverse_return(shipment)
-            add_to_record('shipments_delivered', shipment)
-        elif (status == 'cancelled'):
-            if (str(oldstatus).lower() in
-               ['dispatched', 'in-transit', 'delivered', 'returned']):
-                status = str(oldstatus).lower()
-                return status
+        effect = shipment_status_effect(oldstatus, status)
+        if effect.keep_old:
+            # Refused by the table, the old status is kept lowercased. A
+            # return from a status the table does not know keeps it as it
+            # was set, which may be no status at all.
+            if (str(oldstatus).lower(), status) in STATUS_TRANSITIONS:
+                return str(oldstatus).lower()
+            return oldstatus
+        for record in effect.records:
+            if record.startswith('un'):
+                recorded = session.recorded('shipments_%s' % record[2:])
+                if recorded is not None:
+                    recorded.discard(shipment)
             else:
-                for item in shipment.contents:
-                    item.sku.to_be_shipped -= item.quantity
-        elif status == 'returned':
-            if (str(oldstatus).lower() not in
-               ['dispatched', 'in-transit', 'delivered']):
-                status = oldstatus
-                return status
-            else:
-                if 'shipments_returned' not in g:
-                    setattr(g, 'shipments_returned', [])
-                if shipment not in g.shipments_returned and\
-                        oldstatus != 'returned':
-                    g.shipments_returned.append(shipment)
-                for item in shipment.contents:
-                        item.sku.stock_in_inventory += item.quantity
+                session.record('shipments_%s' % record, shipment)
+        if effect.to_be_shipped or effect.stock:
+            # Applied to the skus at commit, for all the shipments at once
+            session.record(
+                'shipment_sku_deltas',
+                (shipment, effect.to_be_shipped, effect.stock), unique=False)
         return status
 
+    def apply_sku_deltas(self, session, shipment_deltas):
+        """
+        Adds up the inventory changes of the status changes of all the
+        shipments per sku, and applies them with one UPDATE per sku. The
+        contents of the shipments are loaded in IN batches and the skus
+        are not loaded at all, except those which run out of stock.
+        """
+        _load_collection(session, set(s for s, t, st in shipment_deltas),
+                         'contents')
+        sku_deltas = {}
+        for shipment, to_be_shipped, stock in shipment_deltas:
+            for item in shipment.contents:
+                delta = sku_deltas.setdefault(item.sku_id, [0, 0])
+                delta[0] += to_be_shipped * item.quantity
+                delta[1] += stock * item.quantity
+        # Pending changes to the skus would overwrite the UPDATEs if they
+        # were flushed after them
+        session.flush()
+        for sku_id, (to_be_shipped, stock) in sku_deltas.iteritems():
+            if to_be_shipped or stock:
+                session.query(SKU).filter(SKU.id == sku_id).update({
+                    SKU.to_be_shipped: SKU.to_be_shipped + to_be_shipped,
+                    SKU.stock_in_inventory: SKU.stock_in_inventory + stock
+                }, synchronize_session='evaluate')
+        record_bulk_write(session, SKU, sku_deltas.keys())
+        # The test of on_out_of_stock, made once per sku on its values
+        # after all the deltas rather than on every change. A sku which
+        # runs out and gets stock back within the commit is not recorded.
+        changed = [sku_id for sku_id, (to_be_shipped, stock)
+                   in sku_deltas.iteritems() if to_be_shipped]
+        for i in range(0, len(changed), IN_BATCH_SIZE):
+            for sku in session.query(SKU).filter(
+                    SKU.id.in_(changed[i:i+IN_BATCH_SIZE]),
+                    SKU.stock_in_inventory - SKU.to_be_shipped <= 0,
+                    SKU.stock_in_inventory != 0, SKU.to_be_shipped != 0):
+                add_to_record('out_of_stock', sku)
+
+    def reserve_skus(self, session, skus_in_shipments):
+        """
+        Adds the quantities of new skus in shipments, which are not made
+        of order items, to the to_be_shipped of their skus. Skus without
+        available stock take them as to_be_shipped_on_stock_addition
+        instead, and their shipments wait for stock.
+
+        The shipments, their order items and the skus are loaded with one
+        IN query each per batch. The skus in shipments are then allocated
+        one by one, in the order they were added, each against the stock
+        the ones before it left available.
+        """
+        Shipment.get_all(list(set(
+            sis.shipment_id for sis in skus_in_shipments
+            if sis.shipment_id is not None and
+            'shipment' in inspect(sis).unloaded)))
+        _load_collection(
+            session, set(sis.shipment for sis in skus_in_shipments),
+            'with_order_item_instances')
+        to_reserve = [
+            sis for sis in skus_in_shipments
+            if (not hasattr(sis.shipment, 'with_order_item_instances') or
+                len(sis.shipment.with_order_item_instances) == 0)]
+        sku_ids = list(set(sis.sku_id for sis in to_reserve))
+        skus = dict(zip(sku_ids, SKU.get_all(sku_ids)))
+        for sis in to_reserve:
+            sku = skus[sis.sku_id]
+            if sku.available_stock > 0:
+                sku.to_be_shipped = sku.to_be_shipped + sis.quantity
+            else:
+                if not sku.to_be_shipped_on_stock_addition:
+                    sku.to_be_shipped_on_stock_addition = 0
+                sku.to_be_shipped_on_stock_addition += sis.quantity
+                sis.waiting_for_stock_addition = True
+                sis.shipment.status = 'waiting_for_stock_addition'
+
+    def deactivate_sold_out_campaigns(self, session, sku_ids):
+        """
+        Deactivates, to be activated again on stock arrival, the active
+        campaigns which have a slot with one of these skus where every
+        other sku is out of stock too. The campaigns are found with one
+        aggregate query per IN_BATCH_SIZE skus and updated with one UPDATE.
+        """
+        link = SKU.in_campaign_slot_instances.property.mapper.class_
+        slot = link.campaign_slot.property.mapper.class_
+        sibling = aliased(SKU)
+        campaign_ids = set()
+        for i in range(0, len(sku_ids), IN_BATCH_SIZE):
+            q = session.query(Campaign.id).select_from(SKU).join(
+                SKU.in_campaign_slot_instances).join(
+                link.campaign).join(link.campaign_slot)
+            q = _join_path(q, slot, 'skus', sibling).filter(
+                SKU.id.in_(sku_ids[i:i+IN_BATCH_SIZE]),
+                Campaign.active == True)
+            in_stock = case([(and_(sibling.id != SKU.id,
+                                   _available_stock(sibling) != 0), 1)],
+                            else_=0)
+            campaign_ids.update(campaign_id for campaign_id, in q.group_by(
+                Campaign.id, slot.id).having(func.sum(in_stock) == 0))
+        if campaign_ids:
+            session.query(Campaign).filter(
+                Campaign.id.in_(campaign_ids)).update(
+                {Campaign.active: False,
+                 Campaign.activate_on_stock_arrival: True},
+                synchronize_session='fetch')
+            record_bulk_write(session, Campaign, campaign_ids)
+
     def on_shipment_cost_change(self, shipment, cost,
                                 cost_before,
                                 initiator):
@@ -191,9 +406,11 @@ class EventListener:
                 cost_before = Decimal(0.0)
             amount = cost_before-cost
             if amount < 0:
-                add_to_record('shipment_deductions', (shipment, amount))
+                add_to_record('shipment_deductions', (shipment, amount),
+                              obj=shipment, unique=False)
             elif amount > 0:
-                add_to_record('shipment_refunds', (shipment, amount))
+                add_to_record('shipment_refunds', (shipment, amount),
+                              obj=shipment, unique=False)
 
     def on_qa_passed(self, item_in_warehouse_entry, value,
                      old_value, initiator):
@@ -203,7 +420,8 @@ class EventListener:
             new_addition = value - old_value
             if new_addition != 0:
                 add_to_record('ready_to_process', (
-                    item_in_warehouse_entry, new_addition))
+                    item_in_warehouse_entry, new_addition),
+                    obj=item_in_warehouse_entry, unique=False)
 
     def record_sku_addition(self, sku_in_shipment, args, kwargs):
         add_to_record('skus_to_be_shipped', sku_in_shipment)
@@ -223,6 +441,21 @@ class EventListener:
     #     add_to_record('new_printables', printable)
 
     def do_before_commit(self, session):
+        # Processing the records can record more, like the status changes
+        # of the shipments which reserve_skus sets waiting for stock. Records
+        # which still keep coming after max_commit_passes fail the commit.
+        # The passes before have flushed and written in the transaction, so
+        # the caller has to roll the session back.
+        for i in range(self.max_commit_passes):
+            self.process_records(session)
+            if not any(session.recorded(key) for key in COMMIT_RECORDS):
+                return
+        raise RuntimeError(
+            "Commit records still pending after %d passes: %s" % (
+                self.max_commit_passes, ', '.join(
+                    key for key in COMMIT_RECORDS if session.recorded(key))))
+
+    def process_records(self, session):
         # if 'new_skus' in g:
         #     for sk in g.new_skus:
         #         if sk.category is 'other_sku':
@@ -266,45 +499,51 @@ class EventListener:
         #                 else:
         #                     p.label += '-NA'
         #     g.new_printables = []
-        if 'shipment_deductions' in g:
-            for shipment, amount in g.shipment_deductions:
-                # The amount here will be a negative value
-                User.get(shipment.user_id).account_balance += amount
-                ShipmentDeduction.build(
-                    amount=amount, shipment_id=shipment.id,
-                    user_id=shipment.user_id)
-            g.shipment_deductions = []
-        if 'ready_to_process' in g:
-            for item_in_warehouse_entry, new_addition in g.ready_to_process:
-                item_in_warehouse_entry.order_item_printable.ready_to_process += new_addition
-            g.ready_to_process = []
-        if 'shipment_refunds' in g:
-            for shipment, amount in g.shipment_refunds:
-                # The amount here will be a positive value
-                User.get(shipment.user_id).account_balance += amount
-                ShipmentRefund.build(
-                    amount=amount, shipment_id=shipment.id,
-                    user_id=shipment.user_id)
-            g.shipment_refunds = []
-        if 'status_changed_shipments' in g:
-            for shipment in g.status_changed_shipments:
-                shipment.last_acted_at = ist_now()
-            del g.status_changed_shipments
+        shipment_sku_deltas = session.pop_record('shipment_sku_deltas')
+        if shipment_sku_deltas:
+            self.apply_sku_deltas(session, shipment_sku_deltas)
+        # Deductions are negative amounts and refunds positive ones
+        ledger = (
+            (ShipmentDeduction, session.pop_record('shipment_deductions')),
+            (ShipmentRefund, session.pop_record('shipment_refunds')))
+        if any(entries for model, entries in ledger):
+            # Pending changes go out first, so that the ids of new shipments
+            # are known and no later flush of a changed user overwrites the
+            # balance updated below
+            session.flush()
+            balance_deltas = {}
+            for model, entries in ledger:
+                for shipment, amount in entries:
+                    balance_deltas[shipment.user_id] = balance_deltas.get(
+                        shipment.user_id, 0) + amount
+                if entries:
+                    session.bulk_insert_mappings(model, [
+                        dict(amount=amount, shipment_id=shipment.id,
+                             user_id=shipment.user_id)
+                        for shipment, amount in entries])
+                    record_bulk_write(session, model)
+            for user_id, delta in balance_deltas.iteritems():
+                if delta != 0:
+                    session.query(User).filter(User.id == user_id).update(
+                        {User.account_balance: User.account_balance + delta},
+                        synchronize_session='evaluate')
+            record_bulk_write(session, User, balance_deltas.keys())
+        for item_in_warehouse_entry, new_addition in session.pop_record(
+                'ready_to_process'):
+            item_in_warehouse_entry.order_item_printable.ready_to_process += new_addition
         notifications = []
-        if 'shipments_delivered' in g:
+        shipments_delivered = session.pop_record('shipments_delivered')
+        if shipments_delivered:
             notifications += ShipmentDeliveryService(
-                ).build_all_from_shipments(g.shipments_delivered)
-            g.shipments_delivered = []
-        if 'claims_redeemed' in g:
+                ).build_all_from_shipments(list(shipments_delivered))
+        claims_redeemed = session.pop_record('claims_redeemed')
+        if claims_redeemed:
             notifications += ClaimRedemptionService(
-                ).build_all_from_claims(g.claims_redeemed)
-            for claim in g.claims_redeemed:
-                try:
-                    if claim.user.has_claim_redemption_notify_hook:
-                        post_claim_redemption(claim)
-                except:
-                    pass
-            g.claims_redeemed = []
+                ).build_all_from_claims(list(claims_redeemed))
+            for claim in claims_redeemed:
+                if claim.user.has_claim_redemption_notify_hook:
+                    webhooks.enqueue(
+                        session, deliver_claim_redemption, claim.id)
         
         # if 'claims_revoked' in g:
         #     notifications += ClaimRevocationService(
@@ -323,45 +562,26 @@ class EventListener:
 
 
         #     del g.new_priceables
-        if 'skus_to_be_shipped' in g:
-            for sis in g.skus_to_be_shipped:
-                if (not hasattr(sis.shipment, 'with_order_item_instances') or
-                        len(sis.shipment.with_order_item_instances) == 0):
-                    sku = session.query(SKU).get(sis.sku_id)
-                    if sku.available_stock > 0:
-                        sku.to_be_shipped = sku.to_be_shipped + sis.quantity
-                    else:
-                        if not sku.to_be_shipped_on_stock_addition:
-                            sku.to_be_shipped_on_stock_addition = 0
-                        sku.to_be_shipped_on_stock_addition += sis.quantity
-                        sis.waiting_for_stock_addition = True
-                        sis.shipment.status = 'waiting_for_stock_addition'
-            del g.skus_to_be_shipped
+        skus_to_be_shipped = session.pop_record('skus_to_be_shipped')
+        if skus_to_be_shipped:
+            self.reserve_skus(session, list(skus_to_be_shipped))
+        # After reserve_skus, which can set shipments waiting for stock
+        for shipment in session.pop_record('status_changed_shipments'):
+            shipment.last_acted_at = ist_now()
         session.add_all(notifications)
 
         alerts = []
-        if 'shipments_returned' in g:
-            while len(g.shipments_returned) > 0:
-                shipment = g.shipments_returned.pop()
-                alerts.append(ShipmentReturnedAlert(
-                    shipment_id=shipment.id, user_id=shipment.user_id))
-            del g.shipments_returned
-        if 'out_of_stock' in g:
-            while len(g.out_of_stock) > 0:
-                sku = g.out_of_stock.pop()
-                alerts.append(OutOfStockAlert(
-                    sku_id=sku.id, user_id=sku.user_id))
-                for sku_in_campaign_slot in sku.in_campaign_slot_instances:
-                    campaign = sku_in_campaign_slot.campaign
-                    if campaign.active:
-                        other_skus = [
-                            sk for sk in
-                            sku_in_campaign_slot.campaign_slot.skus
-                            if sk != sku]
-                        if all(sk.available_stock == 0
-                               for sk in other_skus):
-                            campaign.active = False
-                            campaign.activate_on_stock_arrival = True
-                            break
-            del g.out_of_stock
+        for shipment in session.pop_record('shipments_returned'):
+            alerts.append(ShipmentReturnedAlert(
+                shipment_id=shipment.id, user_id=shipment.user_id))
+        out_of_stock = session.pop_record('out_of_stock')
+        if out_of_stock:
+            skus = [sku for sku in out_of_stock if sku.id is not None]
+            if skus:
+                session.bulk_insert_mappings(OutOfStockAlert, [
+                    dict(sku_id=sku.id, user_id=sku.user_id)
+                    for sku in skus])
+                record_bulk_write(session, OutOfStockAlert)
+                self.deactivate_sold_out_campaigns(
+                    session, [sku.id for sku in skus])
         session.add_all(alerts)
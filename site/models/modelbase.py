@@ -1,15 +1,28 @@
 from sqlalchemy.ext.associationproxy import AssociationProxy
-import json
 from flask_sqlalchemy import Model, BaseQuery
 from itertools import chain
-from sqlalchemy import func
-from ..utils import place_nulls, subdict, deep_group
-from datetime import datetime
+from sqlalchemy import inspect, and_, or_, String
+from sqlalchemy import orm
+from sqlalchemy.util import KeyedTuple
+from ..utils import subdict, deep_group, LRUCache
+from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
+from flask import abort
 from sqlalchemy.ext.associationproxy import (
     _AssociationDict, _AssociationList)
 from sqlalchemy.orm.collections import (
     InstrumentedList, MappedCollection)
-from ..json_plus import json_encoder
+from ..json_plus import dumps, register_encoder
+from .caching import (serialized_cache, lookup_memo,
+                      query_cache, identity_of, record_bulk_write)
+from hashlib import md5
+
+# selectinload is available only from SQLAlchemy 1.2
+LIST_RELATIONSHIP_LOADER = (
+    'selectinload' if hasattr(orm, 'selectinload') else 'subqueryload')
+
+# Max number of keys sent in a single IN clause
+IN_BATCH_SIZE = 500
 
 
 def parent_classes(obj):
@@ -18,10 +31,7 @@ def parent_classes(obj):
 
 
 def serialized_list(olist, rels_to_expand=[]):
-    return map(
-        lambda o: o.todict(
-            rels_to_expand=rels_to_expand),
-        olist)
+    return map(model_serializer(rels_to_expand=rels_to_expand), olist)
 
 
 def is_list_like(rel_instance):
@@ -36,16 +46,533 @@ def is_dict_like(rel_instance):
         rel_instance, MappedCollection))
 
 
+def _freeze(value):
+    """
+    Turns the (possibly nested) lists and dicts accepted by todict into
+    tuples so that they can be used as a part of a cache key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(
+            (k, _freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def model_serializer(**kwargs):
+    """
+    Returns a callable which serializes objects with `todict` using the
+    given kwargs. The serializer for each class is looked up only once, so
+    this is the cheap way to serialize a long (possibly polymorphic) list.
+    Objects which do not have a `todict` are returned as they are.
+    """
+    serializers = {}
+
+    def serialize(obj):
+        cls = obj.__class__
+        try:
+            return serializers[cls](obj)
+        except KeyError:
+            if isinstance(obj, ModelBase):
+                serializers[cls] = cls.serializer(**kwargs)
+            elif hasattr(obj, 'todict'):
+                serializers[cls] = lambda o: o.todict(**kwargs)
+            else:
+                serializers[cls] = lambda o: o
+            return serializers[cls](obj)
+    return serialize
+
+
+class SerializationPlan(object):
+    """
+    Everything todict needs to know about serializing a model class with a
+    given set of arguments, resolved once. Plans are cached per distinct
+    combination of arguments in `SERIALIZATION_PLANS`.
+    """
+
+    def __init__(self, model, attrs_to_serialize, rels_to_serialize,
+                 rels_to_expand, group_listrels_by, key_modifications):
+        self.model = model
+        self.attrs_to_serialize = attrs_to_serialize
+        self.rels_to_serialize = rels_to_serialize
+        self.group_listrels_by = group_listrels_by
+        self.key_modifications = key_modifications
+        # Convert rels_to_expand to a list of (rel, child_rels) pairs
+        rels_to_expand_dict = {}
+        for rel in rels_to_expand:
+            partitioned_rels = rel.partition('.')
+            child_rels = rels_to_expand_dict.setdefault(
+                partitioned_rels[0], [])
+            if partitioned_rels[-1]:
+                child_rels.append(partitioned_rels[-1])
+        self.rels_to_expand = [
+            (rel, child_rels, model_serializer(rels_to_expand=child_rels))
+            for rel, child_rels in rels_to_expand_dict.iteritems()]
+        self.dict_serializer = model_serializer()
+        # The relationship paths this plan reads itself, like
+        # ('orders', 'items'). See rel_paths.
+        self.own_rel_paths = set(
+            [(rel if isinstance(rel, basestring) else rel[0],)
+             for rel in rels_to_serialize] +
+            [tuple(rel.split('.')) for rel in rels_to_expand])
+        self._rel_paths = None
+        self._loader_options = None
+        self.cached = getattr(model, '_cache_serialized_', False)
+        # Set by ModelBase.serialization_plan. Identifies the plan in the
+        # keys of the serialized object cache.
+        self.cache_id = None
+        # The keys of the serialized dicts in a fixed order. These are the
+        # columns of the columnar form of a list.
+        modified_keys = dict(key_modifications)
+        self.keys = tuple(
+            modified_keys.get(key, key) for key in chain(
+                attrs_to_serialize,
+                (rel for rel, id_attr in rels_to_serialize),
+                (rel for rel, child_rels, s in self.rels_to_expand)))
+
+    @property
+    def rel_paths(self):
+        """
+        Every relationship path this plan will read. Along with its own,
+        these are the paths read by the plans of the expanded objects, which
+        serialize the default rels of their classes. Used to build eager
+        loading options.
+        """
+        if self._rel_paths is None:
+            paths = set(self.own_rel_paths)
+            for rel, child_rels, child_serializer in self.rels_to_expand:
+                target = _rel_target(self.model, rel)
+                if (target is None or not issubclass(target, ModelBase) or
+                        target.todict.im_func is not ModelBase.todict.im_func):
+                    continue
+                child_plan = target.serialization_plan(
+                    rels_to_expand=child_rels)
+                paths.update((rel,) + path for path in child_plan.rel_paths)
+            self._rel_paths = paths
+        return self._rel_paths
+
+    def column_entities(self):
+        """
+        The mapped columns to select in place of whole objects, if this plan
+        reads nothing but plain columns. Rows of these columns are already
+        in the order of `keys`. Returns None if the plan needs the objects,
+        or if the rows may be of subclasses with plans of their own.
+        """
+        model = self.model
+        column_attrs = model.__mapper__.column_attrs
+        if (len(self.attrs_to_serialize) == 0 or self.rels_to_serialize or
+                len(model.__mapper__.self_and_descendants) > 1 or
+                self.rels_to_expand or
+                model.todict.im_func is not ModelBase.todict.im_func or
+                model.serialize_attrs.im_func is not
+                ModelBase.serialize_attrs.im_func or
+                not all(attr in column_attrs
+                        for attr in self.attrs_to_serialize)):
+            return None
+        return [getattr(model, attr) for attr in self.attrs_to_serialize]
+
+    def loader_options(self):
+        """
+        SQLAlchemy loader options which load every relationship in
+        `rel_paths` eagerly. Collections are loaded with a selectin (or
+        subquery) load, scalar relationships with a join. Names which are
+        not relationships (properties etc) end the path.
+        """
+        if self._loader_options is None:
+            options = []
+            for path in sorted(self.rel_paths):
+                option = _loader_option(self.model, path)
+                if option is not None:
+                    options.append(option)
+            self._loader_options = options
+        return self._loader_options
+
+    def serialize(self, obj):
+        if self.cached:
+            return serialized_cache.serialize(self, obj)
+        return self.build(obj)
+
+    def reachable_identities(self, obj):
+        """
+        Identities of all the objects which this plan reads through
+        relationships of `obj`. A change to any of them changes the dict.
+        """
+        for path in self.rel_paths:
+            current = [obj]
+            for rel in path:
+                reached = []
+                for o in current:
+                    rel_obj = getattr(o, rel, None)
+                    if rel_obj is None:
+                        continue
+                    if is_list_like(rel_obj):
+                        reached.extend(rel_obj)
+                    elif is_dict_like(rel_obj):
+                        reached.extend(rel_obj.values())
+                    else:
+                        reached.append(rel_obj)
+                current = reached
+                for o in current:
+                    identity = identity_of(o)
+                    if identity is not None:
+                        yield identity
+
+    def build(self, obj):
+        group_listrels_by = self.group_listrels_by
+
+        # Serialize attrs
+        result = obj.serialize_attrs(*self.attrs_to_serialize)
+
+        # Serialize rels
+        for rel, id_attr in self.rels_to_serialize:
+            rel_obj = getattr(obj, rel, None)
+            if rel_obj is not None:
+                if is_list_like(rel_obj):
+                    if rel in group_listrels_by:
+                        result[rel] = deep_group(
+                            rel_obj,
+                            attr_to_show=id_attr,
+                            keys=group_listrels_by[rel]
+                        )
+                    else:
+                        result[rel] = [getattr(item, id_attr)
+                                       for item in rel_obj]
+                elif is_dict_like(rel_obj):
+                    result[rel] = {k: getattr(v, id_attr)
+                                   for k, v in rel_obj.iteritems()}
+                else:
+                    result[rel] = getattr(rel_obj, id_attr)
+
+        # Expand some rels
+        for rel, child_rels, child_serializer in self.rels_to_expand:
+            rel_obj = getattr(obj, rel, None)
+            if rel_obj is not None:
+                if is_list_like(rel_obj):
+                    if rel in group_listrels_by:
+                        result[rel] = deep_group(
+                            rel_obj,
+                            keys=group_listrels_by[rel],
+                            serializer=child_serializer)
+                    else:
+                        result[rel] = [child_serializer(i) for i in rel_obj]
+                elif is_dict_like(rel_obj):
+                    result[rel] = {k: self.dict_serializer(v)
+                                   for k, v in rel_obj.iteritems()}
+                else:
+                    result[rel] = child_serializer(rel_obj)
+
+        for key, mod_key in self.key_modifications:
+            if key in result:
+                result[mod_key] = result.pop(key)
+
+        return result
+
+
+SERIALIZATION_PLANS = LRUCache(maxsize=1024)
+
+
+def _rel_target(cls, rel):
+    """The class at the other end of the relationship, or association proxy,
+    `rel` of `cls`. None for anything else."""
+    mapper = cls.__mapper__
+    attr = getattr(cls, rel, None)
+    if isinstance(attr, AssociationProxy):
+        if attr.target_collection not in mapper.relationships:
+            return None
+        mapper = mapper.relationships[attr.target_collection].mapper
+        rel = attr.value_attr
+    if rel not in mapper.relationships:
+        return None
+    return mapper.relationships[rel].mapper.class_
+
+
+def _loader_option(cls, path):
+    path = list(path)
+    mapper = cls.__mapper__
+    option = None
+    while path:
+        rel = path.pop(0)
+        attr = getattr(mapper.class_, rel, None)
+        if isinstance(attr, AssociationProxy):
+            # Load the collection behind the proxy and then its targets
+            path[0:0] = [attr.target_collection, attr.value_attr]
+            continue
+        if rel not in mapper.relationships:
+            break
+        relationship = mapper.relationships[rel]
+        loader = (LIST_RELATIONSHIP_LOADER if relationship.uselist
+                  else 'joinedload')
+        option = (getattr(orm, loader)(attr) if option is None
+                  else getattr(option, loader)(attr))
+        mapper = relationship.mapper
+    return option
+
+
+def load_relationships(olist, **kwargs):
+    """
+    The counterpart of eager loading for lists which are already loaded.
+    Fills in the relationships which `todict(**kwargs)` will read for all
+    the objects in `olist` by reloading them with the eager loading options
+    in batches of IN_BATCH_SIZE, so that each level of relationships is
+    loaded with one IN query per batch instead of one query per object.
+    Objects which already have those relationships loaded are skipped.
+    """
+    instances_by_class = {}
+    for obj in olist:
+        if isinstance(obj, ModelBase):
+            instances_by_class.setdefault(obj.__class__, []).append(obj)
+    for cls, instances in instances_by_class.iteritems():
+        plan = cls.serialization_plan(**kwargs)
+        options = plan.loader_options()
+        primary_key = cls.__mapper__.primary_key
+        if len(options) == 0 or len(primary_key) != 1:
+            continue
+        first_level_rels = set()
+        for path in plan.rel_paths:
+            attr = getattr(cls, path[0], None)
+            first_level_rels.add(
+                attr.target_collection if isinstance(attr, AssociationProxy)
+                else path[0])
+        keyvals = []
+        for obj in instances:
+            state = inspect(obj)
+            if state.identity is not None and (
+                    first_level_rels & state.unloaded):
+                keyvals.append(state.identity[0])
+        for i in range(0, len(keyvals), IN_BATCH_SIZE):
+            cls.query.filter(
+                primary_key[0].in_(keyvals[i:i+IN_BATCH_SIZE])).options(
+                *options).all()
+    return olist
+
+
+def _is_nullable(attr):
+    try:
+        return attr.property.columns[0].nullable
+    except (AttributeError, IndexError):
+        return True
+
+
+def _key_normalizer(attr, dialect_name):
+    """
+    A function which maps values of `attr` to what its collation compares,
+    so that values the db takes for equal are equal in python as well. None
+    when they compare as they are. String columns compare case-insensitively
+    with a `_ci` or NOCASE collation, and on mysql by default, where
+    trailing spaces are ignored too.
+    """
+    try:
+        column_type = attr.property.columns[0].type
+    except (AttributeError, IndexError):
+        return None
+    if not isinstance(column_type, String):
+        return None
+    collation = (column_type.collation or '').lower()
+    if collation:
+        if not (collation.endswith('_ci') or collation == 'nocase'):
+            return None
+    elif dialect_name != 'mysql':
+        return None
+    strip = dialect_name == 'mysql'
+
+    def normalize(value):
+        if not isinstance(value, basestring):
+            return value
+        if strip:
+            value = value.rstrip(' ')
+        return value.lower()
+    return normalize
+
+
+def _column_value(attr, value):
+    """Converts a json decoded value back to the type of the column"""
+    if value is None or not isinstance(value, basestring):
+        return value
+    try:
+        python_type = attr.property.columns[0].type.python_type
+    except (AttributeError, IndexError, NotImplementedError):
+        return value
+    if python_type is datetime:
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        abort(400, 'Invalid value for %s: %s' % (attr.key, value))
+    elif python_type in (date, Decimal):
+        try:
+            if python_type is date:
+                return datetime.strptime(value, '%Y-%m-%d').date()
+            return Decimal(value)
+        except (ValueError, TypeError, InvalidOperation):
+            abort(400, 'Invalid value for %s: %s' % (attr.key, value))
+    elif python_type in (int, long):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return value
+
+
 class QueryPlus(BaseQuery):
 
     cls = None
 
+    # (ttl, region) when the results are to be cached
+    _cache_options = None
+
+    def cached(self, ttl=None, region='default'):
+        """Serves the results of this query from the query cache `region`
+        for up to `ttl` seconds, or until a commit writes to one of the
+        tables it reads. Queries for one model cache the primary keys and
+        load the instances back from the identity map, or with one IN query
+        per batch, without any loader options. Queries for columns cache
+        the rows.
+        """
+        q = self._clone()
+        q._cache_options = (ttl, region)
+        return q
+
+    def __iter__(self):
+        if self._cache_options is None or not query_cache.enabled:
+            return super(QueryPlus, self).__iter__()
+        ttl, region = self._cache_options
+        descriptions = self.column_descriptions
+        # The type of an entity is its class, that of a column its sql type
+        entities = [d for d in descriptions if isinstance(d['type'], type)]
+        load_rows = super(QueryPlus, self).__iter__
+        if len(descriptions) == 1 and len(entities) == 1:
+            cls = entities[0]['type']
+            mapper = inspect(cls, raiseerr=False)
+            if mapper is None or len(mapper.primary_key) != 1:
+                return load_rows()
+            pks = query_cache.fetch(
+                self,
+                lambda: [inspect(obj).identity[0] for obj in load_rows()],
+                ttl=ttl, region=region)
+            return iter([obj for obj in cls.get_all(
+                pks, key=mapper.get_property_by_column(
+                    mapper.primary_key[0]).key) if obj is not None])
+        if entities:
+            return load_rows()
+        labels = [d['name'] for d in descriptions]
+        rows = query_cache.fetch(
+            self, lambda: [tuple(row) for row in load_rows()],
+            ttl=ttl, region=region)
+        return iter([KeyedTuple(row, labels) for row in rows])
+
+    def primary(self):
+        """Runs this query, and the rest of the session, on the primary"""
+        self.session.use_primary()
+        return self
+
     def desc(self, attr='id'):
         return self.order_by(getattr(self.cls, attr).desc())
 
     def asc(self, attr='id'):
         return self.order_by(getattr(self.cls, attr))
 
+    def seek(self, after=None, attr='id', descending=False):
+        """Keyset pagination. Orders the query by (attr, id) and, given the
+        (attr value, id) of the last row already seen as `after`, keeps
+        only the rows which come after it. Unlike an OFFSET, the db can
+        seek straight to them through an index on (attr, id).
+
+        NULLs of a nullable `attr` come after every value, or before every
+        value when descending, whatever the db does by default. They are
+        ordered by id among themselves, and a cursor at a NULL continues
+        through the rest of them.
+        """
+        col = getattr(self.cls, attr)
+        pk = self.cls.id
+        q = self
+        if attr == 'id':
+            if after is not None:
+                q = q.filter(pk < after[1] if descending else pk > after[1])
+            return q.order_by(pk.desc() if descending else pk)
+        nullable = _is_nullable(col)
+        if after is not None:
+            value, last_id = after
+            value = _column_value(col, value)
+            past_pk = pk < last_id if descending else pk > last_id
+            if value is None:
+                past = and_(col.is_(None), past_pk)
+                if descending:
+                    past = or_(past, col.isnot(None))
+            else:
+                past_col = col < value if descending else col > value
+                past = or_(past_col, and_(col == value, past_pk))
+                if nullable and not descending:
+                    past = or_(past, col.is_(None))
+            q = q.filter(past)
+        order = [col.desc(), pk.desc()] if descending else [col, pk]
+        if nullable:
+            is_null = col.is_(None)
+            order.insert(0, is_null.desc() if descending else is_null)
+        return q.order_by(*order)
+
+    def stream(self, batch_size=1000, expunge=True, server_side=False):
+        """Yields the results in windows of `batch_size` rows over the
+        primary key (WHERE id > last ORDER BY id LIMIT n), so that the cost
+        of a window does not grow with the ones before it like an OFFSET
+        would. Any ordering of the query is replaced by the primary key. A
+        query with a limit or an offset is wrapped in a subquery first, so
+        that the windows cover the rows it selects, in its own ordering.
+
+        With `expunge`, every window is flushed and then removed from the
+        session before the next one is fetched, which keeps memory flat
+        over any number of rows while keeping the changes made to the
+        objects. `server_side` fetches each window through a server side
+        cursor on the dialects which support one.
+        """
+        mapper = inspect(self.cls)
+        if len(mapper.primary_key) != 1:
+            raise ValueError(
+                '%s has a composite primary key' % self.cls.__name__)
+        pk = getattr(self.cls, mapper.get_property_by_column(
+            mapper.primary_key[0]).key)
+        if self._limit is not None or self._offset is not None:
+            q = self.from_self().order_by(pk)
+        else:
+            q = self.order_by(None).order_by(pk)
+        if server_side:
+            q = q.execution_options(stream_results=True)
+        last = None
+        while True:
+            window = q if last is None else q.filter(pk > last)
+            batch = window.limit(batch_size).all()
+            if len(batch) == 0:
+                return
+            last = inspect(batch[-1]).identity[0]
+            for obj in batch:
+                yield obj
+            if expunge:
+                self.session.flush()
+                for obj in batch:
+                    if obj in self.session:
+                        self.session.expunge(obj)
+            if len(batch) < batch_size:
+                return
+            batch = None
+
+    def eager_load(self, attrs_to_serialize=None,
+                   rels_to_expand=None,
+                   rels_to_serialize=None,
+                   group_listrels_by=None,
+                   key_modifications=None):
+        """Adds the loader options for everything that todict will read
+        with these arguments to the query.
+        """
+        if self.cls is None:
+            return self
+        options = self.cls.serialization_plan(
+            attrs_to_serialize=attrs_to_serialize,
+            rels_to_expand=rels_to_expand,
+            rels_to_serialize=rels_to_serialize,
+            group_listrels_by=group_listrels_by,
+            key_modifications=key_modifications).loader_options()
+        return self.options(*options) if options else self
+
 
 class ModelBase(Model):
 
@@ -60,6 +587,17 @@ class ModelBase(Model):
 
     _group_listrels_by_ = {}
 
+    # Keep the serialized dicts of this model in the serialized object
+    # cache. Only for models whose dicts are built from columns and
+    # relationships alone. Properties computed from other tables will
+    # not be invalidated.
+    _cache_serialized_ = False
+
+    # A UTC timestamp column updated on every write. When set, the list
+    # responses compute their ETag and Last-Modified from its max instead
+    # of hashing the body.
+    _last_modified_attr_ = None
+
     __no_overwrite__ = []
 
     session = None
@@ -76,114 +614,63 @@ class ModelBase(Model):
                 rel_instance.target_collection].uselist
         return False
 
+    @classmethod
+    def serialization_plan(cls, attrs_to_serialize=None,
+                           rels_to_expand=None,
+                           rels_to_serialize=None,
+                           group_listrels_by=None,
+                           key_modifications=None):
+        """Returns the cached `SerializationPlan` of this class for the given
+        arguments, compiling it on first use. Arguments left as `None` fall
+        back to the class level defaults.
+        """
+        key = (cls, _freeze(attrs_to_serialize), _freeze(rels_to_expand),
+               _freeze(rels_to_serialize), _freeze(group_listrels_by),
+               _freeze(key_modifications))
+        plan = SERIALIZATION_PLANS.get(key)
+        if plan is None:
+            plan = SerializationPlan(
+                cls,
+                attrs_to_serialize=tuple(
+                    cls._attrs_to_serialize_ if attrs_to_serialize is None
+                    else attrs_to_serialize),
+                rels_to_serialize=tuple(
+                    cls._rels_to_serialize_ if rels_to_serialize is None
+                    else rels_to_serialize),
+                rels_to_expand=tuple(
+                    cls._rels_to_expand_ if rels_to_expand is None
+                    else rels_to_expand),
+                group_listrels_by=dict(
+                    cls._group_listrels_by_ if group_listrels_by is None
+                    else group_listrels_by),
+                key_modifications=tuple(dict(
+                    cls._key_modifications_ if key_modifications is None
+                    else key_modifications).items()))
+            plan.cache_id = md5(repr(key[1:])).hexdigest()[:16]
+            SERIALIZATION_PLANS.set(key, plan)
+        return plan
+
+    @classmethod
+    def serializer(cls, **kwargs):
+        """Returns a callable which serializes instances of this class like
+        `todict(**kwargs)` would, without looking up the plan again.
+        """
+        if cls.todict.im_func is not ModelBase.todict.im_func:
+            # A subclass has its own todict. Respect it.
+            return lambda obj: obj.todict(**kwargs)
+        return cls.serialization_plan(**kwargs).serialize
+
     def todict(self, attrs_to_serialize=None,
                rels_to_expand=None,
                rels_to_serialize=None,
                group_listrels_by=None,
                key_modifications=None):
-
-        attrs_to_serialize = (
-            self._attrs_to_serialize_ if attrs_to_serialize is None
-            else attrs_to_serialize)
-        rels_to_serialize = (
-            self._rels_to_serialize_ if rels_to_serialize is None
-            else rels_to_serialize)
-        rels_to_expand = (
-            self._rels_to_expand_ if rels_to_expand is None
-            else rels_to_expand)
-        # assoc_proxies_to_expand = (
-        #     self._assoc_proxies_to_expand_ if assoc_proxies_to_expand is None
-        #     else assoc_proxies_to_expand)
-        key_modifications = (
-            self._key_modifications_ if key_modifications is None
-            else key_modifications)
-        group_listrels_by = (
-            self._group_listrels_by_ if group_listrels_by is None
-            else group_listrels_by)
-        # Convert rels_to_expand to a dictionary
-        rels_to_expand_dict = {}
-        for rel in rels_to_expand:
-            partitioned_rels = rel.partition('.')
-            if partitioned_rels[0] not in rels_to_expand_dict:
-                rels_to_expand_dict[partitioned_rels[0]] = (
-                    [partitioned_rels[-1]] if partitioned_rels[-1]
-                    else [])
-            else:
-                if partitioned_rels[-1]:
-                    rels_to_expand_dict[partitioned_rels[0]].append(
-                        partitioned_rels[-1])
-
-        # # Convert grouplistrelsby to a dict
-        # group_listrels_dict = {}
-        # for rel_to_group, grouping_keys in group_listrels_by.iteritems():
-        #     partitioned_rel_to_group = rel_to_group.partition('.')
-        #     if partitioned_rel_to_group[0] not in group_listrels_dict:
-        #         group_listrels_dict[partitioned_rel_to_group[0]] = (
-        #             {partitioned_rel_to_group[-1]: grouping_keys}
-        #             if partitioned_rel_to_group[-1] else grouping_keys)
-        #     else:
-        #         if partitioned_rel_to_group[-1]:
-        #             group_listrels_dict[
-        #                 partitioned_rel_to_group[0]][
-        #                     partitioned_rel_to_group[-1]] = grouping_keys
-
-        # Serialize attrs
-        result = self.serialize_attrs(*attrs_to_serialize)
-
-        # Serialize rels
-        if len(rels_to_serialize) > 0:
-            for rel, id_attr in rels_to_serialize:
-                rel_obj = getattr(self, rel, None)
-                if rel_obj is not None:
-                    if is_list_like(rel_obj):
-                        if (group_listrels_by is not None and
-                                rel in group_listrels_by):
-                            result[rel] = deep_group(
-                                rel_obj,
-                                attr_to_show=id_attr,
-                                keys=group_listrels_by[rel]
-                            )
-                        else:
-                            result[rel] = [getattr(item, id_attr)
-                                           for item in rel_obj]
-                    elif is_dict_like(rel_obj):
-                        result[rel] = {k: getattr(v, id_attr)
-                                       for k, v in rel_obj.iteritems()}
-                    else:
-                        result[rel] = getattr(rel_obj, id_attr)
-
-        # Expand some rels
-        for rel, child_rels in rels_to_expand_dict.iteritems():
-            rel_obj = getattr(self, rel, None)
-            if rel_obj is not None:
-                if is_list_like(rel_obj):
-                    if (group_listrels_by is not None and
-                            rel in group_listrels_by):
-                        result[rel] = deep_group(
-                            rel_obj,
-                            keys=group_listrels_by[rel], serializer='todict',
-                            serializer_kwargs={'rels_to_expand': child_rels}
-                        )
-                    else:
-                        result[rel] = [i.todict(rels_to_expand=child_rels)
-                                       if hasattr(i, 'todict') else i
-                                       for i in rel_obj]
-                        # result[rel] = serialized_list(
-                        #     rel_obj, rels_to_expand=child_rels)
-                elif is_dict_like(rel_obj):
-                    result[rel] = {k: v.todict()
-                                   if hasattr(v, 'todict') else v
-                                   for k, v in rel_obj.iteritems()}
-                else:
-                    result[rel] = rel_obj.todict(
-                        rels_to_expand=child_rels) if hasattr(
-                        rel_obj, 'todict') else rel_obj
-
-        for key, mod_key in key_modifications.items():
-            if key in result:
-                result[mod_key] = result.pop(key)
-
-        return result
+        return self.serialization_plan(
+            attrs_to_serialize=attrs_to_serialize,
+            rels_to_expand=rels_to_expand,
+            rels_to_serialize=rels_to_serialize,
+            group_listrels_by=group_listrels_by,
+            key_modifications=key_modifications).serialize(self)
 
     def serialize_attrs(self, *args):
         return dict([(a, getattr(self, a)) for a in args])
@@ -192,13 +679,12 @@ class ModelBase(Model):
                rels_to_expand=None,
                rels_to_serialize=None,
                key_modifications=None):
-        return json.dumps(
+        return dumps(
             self.todict(
                 attrs_to_serialize=attrs_to_serialize,
                 rels_to_expand=rels_to_expand,
                 rels_to_serialize=rels_to_serialize,
-                key_modifications=key_modifications),
-            default=json_encoder)
+                key_modifications=key_modifications))
 
     def update(self, **kwargs):
         kwargs = self._preprocess_params(kwargs)
@@ -298,7 +784,10 @@ class ModelBase(Model):
 
         :param **kwargs: filter parameters
         """
-        return cls.filter(*criterion, **kwargs).first()
+        if criterion or 'limit' in kwargs or 'reverse' in kwargs:
+            return cls.filter(*criterion, **kwargs).first()
+        return lookup_memo.lookup(
+            cls, kwargs, lambda: cls.filter(**kwargs).first())
 
     @classmethod
     def one(cls, *criterion, **kwargs):
@@ -366,24 +855,58 @@ class ModelBase(Model):
                 return cls.query.filter_by(id=keyval, user_id=user_id).one()
             return cls.query.get(keyval)
         else:
-            result = cls.query.filter(
-                getattr(cls, key) == keyval)
+            criteria = {key: keyval}
             if user_id and hasattr(cls, 'user_id'):
-                result = result.filter(cls.user_id == user_id)
-            return result.one()
+                criteria['user_id'] = user_id
+            return lookup_memo.lookup(
+                cls, criteria, lambda: cls._get(key, keyval, user_id=user_id))
 
     @classmethod
     def get_all(cls, keyvals, key='id', user_id=None):
+        """Returns one instance per value of `key` in `keyvals`, in their
+        order, with None in the places of values which have no instance.
+        Primary keys already in the session are served from its identity
+        map, the rest are fetched in IN batches of IN_BATCH_SIZE. Values of
+        a column with a case-insensitive collation match in any case.
+        """
         if len(keyvals) == 0:
             return []
-        resultset = cls.query.filter(getattr(cls, key).in_(keyvals))
-        if user_id and hasattr(cls, 'user_id'):
-            resultset = resultset.filter(cls.user_id == user_id)
-        # We need the results in the same order as the input keyvals
-        # So order by field in SQL
-        resultset = resultset.order_by(
-            func.field(getattr(cls, key), *keyvals))
-        return place_nulls(key, keyvals, resultset.all())
+        attr = getattr(cls, key)
+        keyvals = [_column_value(attr, keyval) for keyval in keyvals]
+        norm = cls._key_normalizer(key) or (lambda value: value)
+        check_user = bool(user_id) and hasattr(cls, 'user_id')
+        found = {}
+        mapper = inspect(cls)
+        if (key in cls.__table__.columns
+                and len(mapper.primary_key) == 1
+                and mapper.primary_key[0] is cls.__table__.columns[key]):
+            identity_map = cls.session.identity_map
+            for keyval in keyvals:
+                obj = identity_map.get(
+                    mapper.identity_key_from_primary_key([keyval]))
+                if (obj is not None and isinstance(obj, cls)
+                        and obj not in cls.session.deleted
+                        and not (check_user and obj.user_id != user_id)):
+                    found[norm(keyval)] = obj
+        missing = {}
+        for keyval in keyvals:
+            if norm(keyval) not in found:
+                missing.setdefault(norm(keyval), keyval)
+        missing = missing.values()
+        for i in range(0, len(missing), IN_BATCH_SIZE):
+            resultset = cls.query.filter(
+                attr.in_(missing[i:i+IN_BATCH_SIZE]))
+            if check_user:
+                resultset = resultset.filter(cls.user_id == user_id)
+            for obj in resultset:
+                found.setdefault(norm(getattr(obj, key)), obj)
+        return [found.get(norm(keyval)) for keyval in keyvals]
+
+    @classmethod
+    def _key_normalizer(cls, key):
+        """The normalizer of the values of `key`, see _key_normalizer"""
+        dialect = cls.session.get_bind(mapper=cls.__mapper__).dialect
+        return _key_normalizer(getattr(cls, key), dialect.name)
 
     # @classmethod
     # def get_all(cls, ids, user_id=None):
@@ -418,11 +941,15 @@ class ModelBase(Model):
         :param **kwargs: instance parameters
         """
         keys = kwargs.pop('keys') if 'keys' in kwargs else []
+        cls.session().use_primary()
         return cls.first(**subdict(kwargs, keys)) or cls.create(**kwargs)
 
     @classmethod
     def update_or_create(cls, **kwargs):
         keys = kwargs.pop('keys') if 'keys' in kwargs else []
+        # Read what is about to be written from the primary, not a replica
+        # which may lag behind it
+        cls.session().use_primary()
         obj = cls.first(**subdict(kwargs, keys))
         if obj is not None:
             for key, value in kwargs.iteritems():
@@ -439,38 +966,308 @@ class ModelBase(Model):
         return obj
 
     @classmethod
-    def create_all(cls, list_of_kwargs):
+    def create_all(cls, list_of_kwargs, fast=False, commit=True, load=True):
+        """Returns new instances created from `list_of_kwargs`, saved if
+        `commit`. Without `load`, returns their primary keys instead.
+
+        With `fast`, rows made of columns alone are inserted with multi row
+        INSERTs of up to IN_BATCH_SIZE rows, without building instances or
+        going through the unit of work, and the instances are loaded back
+        by primary key, unless `load` is False. Models with init, set or
+        insert listeners or validators, and inheritance hierarchies, always
+        take the ORM path.
+        """
+        if fast:
+            result = cls._bulk_insert(list_of_kwargs, commit=commit, load=load)
+            if result is not None:
+                return result
         try:
-            return cls.add_all([
-                cls.new(**kwargs) for kwargs in list_of_kwargs])
+            objs = cls.add_all([
+                cls.new(**kwargs) for kwargs in list_of_kwargs],
+                commit=commit and load)
+            if load:
+                return objs
+            # Read before the commit, which would expire them
+            cls.session.flush()
+            keys = [inspect(obj).identity for obj in objs]
+            if commit:
+                cls.session.commit()
+            return [key[0] if len(key) == 1 else key for key in keys]
         except:
             cls.session.rollback()
             raise
 
     @classmethod
-    def find_or_create_all(cls, list_of_kwargs, keys=[]):
-        return cls.add_all([
-            cls.first(**subdict(kwargs, keys)) or cls.new(**kwargs)
-            for kwargs in list_of_kwargs])
+    def _has_orm_listeners(cls):
+        """Whether the model has listeners of its own which a bulk insert
+        would skip. The init listener of the mapper itself, the backref
+        listeners of relationships and the listeners registered for every
+        mapper, like the signals of flask_sqlalchemy, do not count.
+        """
+        mapper = cls.__mapper__
+        manager = mapper.class_manager
+        if mapper.validators:
+            return True
+        if any(fn.__name__ not in ('_event_on_init', '_event_on_first_init')
+               for fn in manager.dispatch.init):
+            return True
+        if (mapper.dispatch.before_insert.listeners or
+                mapper.dispatch.after_insert.listeners):
+            return True
+        return any(manager[prop.key].dispatch.set
+                   for prop in mapper.column_attrs)
 
     @classmethod
-    def update_or_create_all(cls, list_of_kwargs, keys=[]):
-        objs = []
+    def _inserted_ids(cls, stmt, size):
+        """Runs a multi row insert of `size` rows and returns the primary
+        keys it generated, in order. None when the db cannot tell them.
+        """
+        session = cls.session
+        dialect = session.get_bind(cls.__mapper__).dialect.name
+        pk = cls.__mapper__.primary_key[0]
+        if dialect == 'postgresql':
+            return [row[0] for row in session.execute(stmt.returning(pk))]
+        if dialect == 'mysql':
+            # The ids of one insert are consecutive unless the auto increment
+            # lock mode is interleaved, or the ids step by more than one, as
+            # they do on multi master setups
+            lock_mode, increment = session.execute(
+                'SELECT @@innodb_autoinc_lock_mode, '
+                '@@auto_increment_increment').first()
+            if lock_mode == 2 or increment != 1:
+                return None
+            first_id = session.execute(stmt).lastrowid
+            return range(first_id, first_id + size)
+        if dialect == 'sqlite':
+            # The write lock is held, so new rowids are max(rowid) + 1 each
+            last_id = session.execute(stmt).lastrowid
+            return range(last_id - size + 1, last_id + 1)
+        return None
+
+    @classmethod
+    def _bulk_insert(cls, list_of_kwargs, commit=True, load=True):
+        mapper = cls.__mapper__
+        if (len(list_of_kwargs) == 0 or len(mapper.tables) != 1 or
+                mapper.polymorphic_on is not None or
+                len(mapper.primary_key) != 1 or cls._has_orm_listeners()):
+            return None
+        column_attrs = mapper.column_attrs
+        rows = [cls._preprocess_params(dict(kwargs))
+                for kwargs in list_of_kwargs]
+        if any(k not in column_attrs for row in rows for k in row):
+            return None
+        pk = mapper.primary_key[0]
+        pk_key = mapper.get_property_by_column(pk).key
+        dialect = cls.session.get_bind(mapper).dialect.name
+        # The ids are read back, and the auto increment settings read,
+        # from the db which takes the inserts
+        cls.session().use_primary()
+        groups = {}
+        for index, row in enumerate(rows):
+            groups.setdefault(frozenset(row.keys()), []).append(index)
+        ids = [None] * len(rows)
+        try:
+            for names, indices in groups.iteritems():
+                columns = dict(
+                    (n, column_attrs[n].columns[0].key) for n in names)
+                batch_size = IN_BATCH_SIZE
+                if dialect == 'sqlite' and len(names) > 0:
+                    # sqlite allows 999 bound parameters per statement
+                    batch_size = min(batch_size, max(1, 999 / len(names)))
+                for i in range(0, len(indices), batch_size):
+                    batch = indices[i:i+batch_size]
+                    values = [dict((columns[n], v)
+                                   for n, v in rows[j].iteritems())
+                              for j in batch]
+                    stmt = cls.__table__.insert().values(values)
+                    if pk_key in names:
+                        cls.session.execute(stmt)
+                        batch_ids = [rows[j][pk_key] for j in batch]
+                    else:
+                        batch_ids = cls._inserted_ids(stmt, len(batch))
+                        if batch_ids is None:
+                            mappings = [rows[j] for j in batch]
+                            cls.session.bulk_insert_mappings(
+                                cls, mappings, return_defaults=True)
+                            batch_ids = [m[pk_key] for m in mappings]
+                    for j, pk_value in zip(batch, batch_ids):
+                        ids[j] = pk_value
+            # Nothing is flushed, so tell the caches about these rows
+            record_bulk_write(cls.session(), cls, ids)
+            if commit:
+                cls.session.commit()
+        except:
+            cls.session.rollback()
+            raise
+        if not load:
+            return ids
+        return cls.get_all(ids, key=pk_key)
+
+    @classmethod
+    def _lookup_all(cls, list_of_kwargs, keys=[]):
+        """Returns the lookup of every row, (key names, key values), and the
+        existing instances by lookup, loaded with one query per IN_BATCH_SIZE
+        rows. Rows which do not look up by columns alone get a None lookup.
+        Key values are normalized like the collation of their column
+        compares them, so that 'A@x.com' finds the row of 'a@x.com' where
+        the db would.
+        """
+        column_attrs = cls.__mapper__.column_attrs
+        lookups = []
+        groups = {}
+        normalizers = {}
         for kwargs in list_of_kwargs:
-            obj = cls.first(**subdict(kwargs, keys))
-            if obj is not None:
+            names = tuple(sorted(subdict(kwargs, keys).keys()))
+            if len(names) == 0 or any(n not in column_attrs for n in names):
+                lookups.append(None)
+                continue
+            for n in names:
+                if n not in normalizers:
+                    normalizers[n] = (cls._key_normalizer(n) or
+                                      (lambda value: value))
+            values = tuple(
+                normalizers[n](_column_value(getattr(cls, n), kwargs[n]))
+                for n in names)
+            lookups.append((names, values))
+            groups.setdefault(names, set()).add(values)
+        found = {}
+        for names, values in groups.iteritems():
+            attrs = [getattr(cls, n) for n in names]
+            values = list(values)
+            for i in range(0, len(values), IN_BATCH_SIZE):
+                batch = values[i:i+IN_BATCH_SIZE]
+                if len(attrs) == 1 and (None,) not in batch:
+                    criterion = attrs[0].in_([v[0] for v in batch])
+                else:
+                    criterion = or_(*[
+                        and_(*[a == v for a, v in zip(attrs, vals)])
+                        for vals in batch])
+                for obj in cls.query.filter(criterion):
+                    found.setdefault(
+                        (names, tuple(normalizers[n](getattr(obj, n))
+                                      for n in names)), obj)
+        return lookups, found
+
+    @classmethod
+    def find_all_by_keys(cls, list_of_kwargs, keys=[]):
+        """Returns the existing instance for every row of `list_of_kwargs`,
+        matched on `keys` (all the kwargs when empty) like `first` would, or
+        None. The results are in the order of the rows.
+        """
+        lookups, found = cls._lookup_all(list_of_kwargs, keys)
+        return [found.get(lookup) if lookup is not None
+                else cls.first(**subdict(kwargs, keys))
+                for lookup, kwargs in zip(lookups, list_of_kwargs)]
+
+    @classmethod
+    def _find_or_new_all(cls, list_of_kwargs, keys=[], overwrite=False):
+        cls.session().use_primary()
+        lookups, found = cls._lookup_all(list_of_kwargs, keys)
+        objs = []
+        for lookup, kwargs in zip(lookups, list_of_kwargs):
+            if lookup is not None:
+                obj = found.get(lookup)
+            else:
+                obj = cls.first(**subdict(kwargs, keys))
+            if obj is None:
+                obj = cls.new(**kwargs)
+                if lookup is not None:
+                    # Later rows with the same keys get this instance
+                    # instead of inserting a duplicate
+                    found[lookup] = obj
+            elif overwrite:
                 for key, value in kwargs.iteritems():
                     if (key not in keys and
                             key not in cls.__no_overwrite__):
                         setattr(obj, key, value)
-            else:
-                obj = cls.new(**kwargs)
             objs.append(obj)
+        return objs
+
+    @classmethod
+    def find_or_create_all(cls, list_of_kwargs, keys=[]):
+        return cls.add_all(cls._find_or_new_all(list_of_kwargs, keys))
+
+    @classmethod
+    def update_or_create_all(cls, list_of_kwargs, keys=[], native=False):
+        """Updates the instances matching the rows of `list_of_kwargs` on
+        `keys`, creates the rest, and returns them all in the order of the
+        rows. The existing instances are loaded in IN batches and the
+        updates and inserts go out in a single flush.
+
+        With `native`, rows made of columns alone are written with the
+        upsert statement of the db (ON DUPLICATE KEY UPDATE on mysql, ON
+        CONFLICT on postgresql and sqlite) instead. This skips the ORM
+        events of the model, and needs a unique constraint on `keys`.
+        """
+        if native:
+            objs = cls._upsert_all(list_of_kwargs, keys)
+            if objs is not None:
+                return objs
+        try:
+            return cls.add_all(cls._find_or_new_all(
+                list_of_kwargs, keys, overwrite=True))
+        except:
+            cls.session.rollback()
+            raise
+
+    @classmethod
+    def _upsert_all(cls, list_of_kwargs, keys):
+        """Runs a native upsert of the rows, commits and returns the
+        instances. Returns None without writing anything when the rows or the
+        dialect do not allow it.
+        """
+        column_attrs = cls.__mapper__.column_attrs
+        if (len(keys) == 0 or len(list_of_kwargs) == 0 or
+                len(cls.__mapper__.tables) != 1):
+            return None
+        names = set(list_of_kwargs[0].keys())
+        if (not set(keys) <= names or
+                any(n not in column_attrs for n in names) or
+                any(set(kwargs.keys()) != names for kwargs in list_of_kwargs)):
+            return None
+        dialect = cls.session.get_bind(cls.__mapper__).dialect.name
         try:
-            return cls.add_all(objs)
+            if dialect == 'mysql':
+                from sqlalchemy.dialects.mysql import insert
+            elif dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            elif dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                return None
+        except ImportError:
+            return None
+        columns = dict((n, column_attrs[n].columns[0].key) for n in names)
+        update_columns = [columns[n] for n in names
+                          if n not in keys and n not in cls.__no_overwrite__]
+        try:
+            for i in range(0, len(list_of_kwargs), IN_BATCH_SIZE):
+                stmt = insert(cls.__table__).values([
+                    dict((columns[n], v) for n, v in kwargs.iteritems())
+                    for kwargs in list_of_kwargs[i:i+IN_BATCH_SIZE]])
+                if dialect == 'mysql':
+                    # Assigning a key to itself keeps the row as it is
+                    stmt = stmt.on_duplicate_key_update(**dict(
+                        (c, stmt.inserted[c])
+                        for c in update_columns or [columns[keys[0]]]))
+                elif update_columns:
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[columns[k] for k in keys],
+                        set_=dict((c, stmt.excluded[c])
+                                  for c in update_columns))
+                else:
+                    stmt = stmt.on_conflict_do_nothing(
+                        index_elements=[columns[k] for k in keys])
+                cls.session.execute(stmt)
+            objs = cls.find_all_by_keys(list_of_kwargs, keys)
+            # Nothing is flushed, so tell the caches about these rows
+            record_bulk_write(cls.session(), cls, [
+                inspect(obj).identity[0] for obj in objs if obj is not None])
+            cls.session.commit()
         except:
             cls.session.rollback()
             raise
+        return objs
 
     @classmethod
     def build(cls, **kwargs):
@@ -487,6 +1284,7 @@ class ModelBase(Model):
 
         :param **kwargs: instance parameters
         """
+        cls.session().use_primary()
         return cls.first(**kwargs) or cls.build(**kwargs)
 
     @classmethod
@@ -500,8 +1298,8 @@ class ModelBase(Model):
 
     @classmethod
     def find_or_build_all(cls, list_of_kwargs):
-        return cls.add_all([cls.first(**kwargs) or cls.new(**kwargs)
-                            for kwargs in list_of_kwargs], commit=False)
+        return cls.add_all(cls._find_or_new_all(list_of_kwargs),
+                           commit=False)
 
     @classmethod
     def update_all(cls, *criterion, **kwargs):
@@ -520,6 +1318,7 @@ class ModelBase(Model):
         :param model: the model to update
         :param **kwargs: update parameters
         """
+        cls.session().use_primary()
         model = cls.get(id)
         for k, v in cls._preprocess_params(kwargs).items():
             setattr(model, k, v)
@@ -533,6 +1332,7 @@ class ModelBase(Model):
         :param model: the model to update
         :param **kwargs: update parameters
         """
+        cls.session().use_primary()
         model = cls.get(id)
         for k, v in cls._preprocess_params(kwargs).items():
             setattr(model, k, v)
@@ -583,3 +1383,5 @@ class ModelBase(Model):
         return [k for k in cls.all_keys() if isinstance(
             getattr(cls, k), AssociationProxy)]
 
+
+register_encoder(ModelBase, lambda obj: obj.todict())
@@ -1,25 +1,38 @@
 from contextlib import contextmanager
 import logging
 from flask.json import _json
-from flask import abort, Response, request, current_app, session
+from flask import (abort, Response, request, current_app, session,
+                   stream_with_context, has_request_context)
+from hashlib import md5
+from sqlalchemy import func as sqlfunc
 from helpers import dthandler
-from functools import wraps
-from .utils import deep_group, merge, add_kv_to_dict, dict_map
+from functools import wraps, partial
+from itertools import islice
+from .utils import deep_group, merge, add_kv_to_dict, boolify, LRUCache
+from .json_plus import json_encoder, dumps, loads
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 import models
-from .models.modelbase import QueryPlus, is_list_like, is_dict_like
+from .models.modelbase import (
+    QueryPlus, is_list_like, is_dict_like, model_serializer,
+    load_relationships)
 from werkzeug.exceptions import HTTPException
 import inspect
-from datetime import datetime
-from decimal import Decimal
+from math import ceil
 from .models import db
-from sqlalchemy.ext.associationproxy import (
-    _AssociationDict, _AssociationList)
+from .models.caching import count_cache, estimated_count
 from .session_manager import current_user_email
 import traceback
 
 
 RESTRICTED = ['limit', 'sort', 'orderby', 'groupby', 'attrs',
-              'rels', 'expand', 'offset', 'page', 'per_page']
+              'rels', 'expand', 'offset', 'page', 'per_page', 'stream',
+              'format', 'after', 'count']
+
+COUNT_MODES = ['exact', 'estimate', 'none']
+
+# Number of rows fetched from the db (and expunged from the session)
+# at a time while streaming a list response
+STREAM_BATCH_SIZE = 500
 
 OPERATORS = ['~', '=', '>', '<', '>=', '!', '<=']
 OPERATOR_FUNC = {
@@ -45,34 +58,38 @@ def serialized_obj(obj, attrs_to_serialize=None,
     return None
 
 
+def obj_serializer(attrs_to_serialize=None,
+                   rels_to_expand=None,
+                   group_listrels_by=None,
+                   rels_to_serialize=None,
+                   key_modifications=None):
+    """
+    Same as serialized_obj, but returns a callable bound to the
+    serialization plans of the given arguments, so that a list can be
+    serialized without resolving the plan once per row.
+    """
+    serialize = model_serializer(
+        attrs_to_serialize=attrs_to_serialize,
+        rels_to_expand=rels_to_expand,
+        group_listrels_by=group_listrels_by,
+        rels_to_serialize=rels_to_serialize,
+        key_modifications=key_modifications)
+
+    def serializer(obj):
+        if obj:
+            if hasattr(obj, 'todict'):
+                return serialize(obj)
+            return str(obj)
+        return None
+    return serializer
+
+
 def serialized_list(olist, **kwargs):
-    return map(
-        lambda o: serialized_obj(o, **kwargs),
-        olist)
+    return map(obj_serializer(**kwargs), olist)
 
 
-def _json_encoder(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, Decimal):
-        return str(obj)
-    elif isinstance(obj, unicode):
-        return obj
-    elif isinstance(obj, db.Model):
-        return obj.todict()
-    elif is_list_like(obj):
-        return [_json_encoder(i) for i in obj]
-    elif is_dict_like(obj):
-        return dict_map(obj, lambda v: _json_encoder(v))
-    else:
-        try:
-            return _json.JSONEncoder().default(obj)
-        except Exception as e:
-            current_app.logger.debug("Cannot serialize")
-            current_app.logger.debug(obj)
-            current_app.logger.debug(type(obj))
-            current_app.logger.debug(e)
-            return unicode(obj)
+# Kept for the modules which still import the encoder from here
+_json_encoder = json_encoder
 
 
 def jsoned(struct, wrap=True, meta=None):
@@ -80,11 +97,9 @@ def jsoned(struct, wrap=True, meta=None):
         output = {'status': 'success', 'result': struct}
         if meta:
             output = merge(output, meta)
-        return _json.dumps(output,
-                           default=_json_encoder)
+        return dumps(output)
     else:
-        return _json.dumps(struct,
-                           default=_json_encoder)
+        return dumps(struct)
 
 
 def jsoned_obj(obj, **kwargs):
@@ -96,14 +111,198 @@ def jsoned_list(olist, **kwargs):
         serialized_list(olist, **kwargs))
 
 
+def _batches(olist, batch_size=STREAM_BATCH_SIZE, prepare_batch=None):
+    """
+    Yields the rows of `olist` as lists of at most `batch_size` rows. When
+    `olist` is a query, the rows are fetched batch by batch with yield_per
+    and every batch is expunged from the session once it has been consumed,
+    so that the session does not keep the whole result set alive.
+    `prepare_batch` is called with every fetched batch before it is yielded.
+    """
+    if isinstance(olist, QueryPlus):
+        rows = iter(olist.yield_per(batch_size))
+        dbsession = olist.session
+    else:
+        rows = iter(olist)
+        dbsession = None
+    while True:
+        batch = list(islice(rows, batch_size))
+        if len(batch) == 0:
+            return
+        if prepare_batch is not None:
+            prepare_batch(batch)
+        yield batch
+        if dbsession is not None:
+            for row in batch:
+                if isinstance(row, db.Model) and row in dbsession:
+                    dbsession.expunge(row)
+
+
+def jsoned_list_chunks(olist, serializer, keyvals_to_merge=None, meta=None,
+                       batch_size=STREAM_BATCH_SIZE, prepare_batch=None):
+    """
+    The streaming counterpart of jsoned. Yields the same wrapped json
+    document as `jsoned(serialized_list(olist), meta=meta)` piece by
+    piece, with one piece per batch of rows.
+    """
+    yield '{"status": "success", "result": ['
+    keyvals = iter(keyvals_to_merge) if keyvals_to_merge else None
+    separator = ''
+    for batch in _batches(olist, batch_size, prepare_batch=prepare_batch):
+        chunks = []
+        for obj in batch:
+            obj_dict = serializer(obj)
+            if keyvals is not None:
+                kvdict = next(keyvals, None)
+                if kvdict is None:
+                    # Same as zip. Stop with the shorter of the two lists.
+                    break
+                obj_dict = merge(obj_dict, kvdict)
+            chunks.append(dumps(obj_dict))
+        if chunks:
+            yield separator + ', '.join(chunks)
+            separator = ', '
+        if len(chunks) < len(batch):
+            break
+    yield ']'
+    if meta:
+        for key, value in meta.iteritems():
+            yield ', %s: %s' % (dumps(key), dumps(value))
+    yield '}'
+
+
+def encode_cursor(orderby, sort, row):
+    return urlsafe_b64encode(dumps(
+        [orderby, sort, getattr(row, orderby), row.id]))
+
+
+def decode_cursor(cursor, orderby, sort):
+    """
+    Returns the (orderby value, id) pair encoded in a cursor. An empty
+    cursor starts from the first row. A cursor which is malformed or which
+    was made for a different ordering is a bad request. So is one whose
+    value does not fit the column, which `seek` finds when it converts it.
+    """
+    if not cursor:
+        return None
+    try:
+        cursor_orderby, cursor_sort, value, last_id = loads(
+            urlsafe_b64decode(str(cursor)))
+    except Exception:
+        abort(400, 'Invalid cursor')
+    if (cursor_orderby, cursor_sort) != (orderby, sort):
+        abort(400, 'Cursor does not match the sort order')
+    if (not isinstance(last_id, (int, long)) or isinstance(last_id, bool) or
+            not isinstance(value, (type(None), basestring, int, long,
+                                   float))):
+        abort(400, 'Invalid cursor')
+    return (value, last_id)
+
+
+def columnar_list(olist, **kwargs):
+    """
+    The compact form of serialized_list. Instead of one dict per object
+    it returns {'columns': [...], 'rows': [[...], ...]}, with the columns
+    taken from the serialization plans of the classes in the list, in the
+    order in which they first appear. A query whose plan reads nothing but
+    plain columns selects just those columns, without loading objects.
+    """
+    keys = []
+    if isinstance(olist, QueryPlus) and olist.cls is not None:
+        plan = olist.cls.serialization_plan(**kwargs)
+        keys = list(plan.keys)
+        entities = plan.column_entities()
+        if entities is not None:
+            return {'columns': keys,
+                    'rows': [list(row) for row in
+                             olist.with_entities(*entities)]}
+    olist = list(olist)
+    seen_classes = set()
+    seen_keys = set(keys)
+    for obj in olist:
+        if obj.__class__ in seen_classes:
+            continue
+        seen_classes.add(obj.__class__)
+        for key in obj.__class__.serialization_plan(**kwargs).keys:
+            if key not in seen_keys:
+                seen_keys.add(key)
+                keys.append(key)
+    serialize = model_serializer(**kwargs)
+    rows = []
+    for obj in olist:
+        obj_dict = serialize(obj)
+        rows.append([obj_dict.get(key) for key in keys])
+    return {'columns': keys, 'rows': rows}
+
+
 def success_json():
     return Response(jsoned({'status': 'success'}, wrap=False),
                     200, mimetype='application/json')
 
 
-def as_json(struct, status=200, wrap=True, meta=None):
-    return Response(jsoned(struct, wrap=wrap, meta=meta),
-                    status, mimetype='application/json')
+def _is_conditional_request():
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def _has_validators():
+    return bool(request.if_none_match or request.if_modified_since)
+
+
+def as_json(struct, status=200, wrap=True, meta=None, conditional=True):
+    """
+    With `conditional` set, a 200 response to a GET gets a strong ETag
+    computed from the body, and becomes a 304 without a body when the
+    client already has the same one.
+    """
+    body = jsoned(struct, wrap=wrap, meta=meta)
+    response = Response(body, status, mimetype='application/json')
+    if conditional and status == 200 and _is_conditional_request():
+        response.set_etag(md5(
+            body.encode('utf-8') if isinstance(body, unicode)
+            else body).hexdigest())
+        response.make_conditional(request)
+    return response
+
+
+def query_validators(query, **serializer_kwargs):
+    """
+    Returns an (etag, last_modified) pair for the rows of a filtered query
+    without loading them. It takes a single aggregate query for the row
+    count and the max of the `_last_modified_attr_` of the model, which
+    are hashed along with the request url and the sql of the query.
+    Returns (None, None) for models without a `_last_modified_attr_`, and
+    when the serialized rows include related objects, whose changes the
+    aggregate does not see.
+    """
+    cls = query.cls
+    if cls is None or cls._last_modified_attr_ is None:
+        return (None, None)
+    if cls.serialization_plan(**serializer_kwargs).rel_paths:
+        return (None, None)
+    count, last_modified = query.order_by(None).with_entities(
+        sqlfunc.count(),
+        sqlfunc.max(getattr(cls, cls._last_modified_attr_))).one()
+    compiled = query.statement.compile()
+    etag = md5(repr((
+        request.url, unicode(compiled), sorted(compiled.params.items()),
+        count, last_modified))).hexdigest()
+    return (etag, last_modified)
+
+
+def is_not_modified(etag, last_modified=None):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(
+            microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
 
 
 def as_json_obj(o, attrs_to_serialize=None,
@@ -129,29 +328,55 @@ def as_json_list(olist, attrs_to_serialize=None,
                  key_modifications=None,
                  groupby=None,
                  keyvals_to_merge=None,
-                 meta=None):
+                 meta=None,
+                 stream=False,
+                 columnar=False,
+                 conditional=True):
+    """
+    With `columnar` set, the result is sent in the compact form built by
+    columnar_list. This takes precedence over streaming. It is not
+    available for grouped lists or with keyvals_to_merge.
+
+    With `stream` set, the list is written out as a generator backed
+    response instead of being built in memory first. A query passed in
+    this mode is fetched and expunged in batches of STREAM_BATCH_SIZE.
+    Grouped lists need all the rows at once and are never streamed.
+
+    The relationships which will be serialized are loaded eagerly. Queries
+    get the loader options, while lists (and streamed batches) have them
+    filled in with batched IN queries by load_relationships.
+    """
+    serializer_kwargs = {
+        'attrs_to_serialize': attrs_to_serialize,
+        'rels_to_expand': rels_to_expand,
+        'group_listrels_by': group_listrels_by,
+        'rels_to_serialize': rels_to_serialize,
+        'key_modifications': key_modifications
+    }
+    if stream and not groupby and not columnar:
+        return Response(stream_with_context(jsoned_list_chunks(
+            olist, obj_serializer(**serializer_kwargs),
+            keyvals_to_merge=keyvals_to_merge, meta=meta,
+            prepare_batch=partial(load_relationships, **serializer_kwargs)
+            )), 200, mimetype='application/json')
+    if isinstance(olist, QueryPlus):
+        olist = olist.eager_load(**serializer_kwargs)
+    else:
+        load_relationships(olist, **serializer_kwargs)
+    if columnar and not groupby and not keyvals_to_merge:
+        return as_json(columnar_list(olist, **serializer_kwargs), meta=meta,
+                       conditional=conditional)
     if groupby:
         result_list = deep_group(
-            olist, keys=groupby, serializer='todict',
-            serializer_kwargs={
-                'rels_to_serialize': rels_to_serialize,
-                'rels_to_expand': rels_to_expand,
-                'attrs_to_serialize': attrs_to_serialize,
-                'group_listrels_by': group_listrels_by,
-                'key_modifications': key_modifications
-            })
+            olist, keys=groupby,
+            serializer=model_serializer(**serializer_kwargs))
     else:
-        result_list = serialized_list(
-            olist, attrs_to_serialize=attrs_to_serialize,
-            rels_to_expand=rels_to_expand,
-            group_listrels_by=group_listrels_by,
-            rels_to_serialize=rels_to_serialize,
-            key_modifications=key_modifications)
+        result_list = serialized_list(olist, **serializer_kwargs)
         if keyvals_to_merge:
             result_list = [merge(obj_dict, kvdict)
                            for obj_dict, kvdict in
                            zip(result_list, keyvals_to_merge)]
-    return as_json(result_list, meta=meta)
+    return as_json(result_list, meta=meta, conditional=conditional)
 
 
 def appropriate_json(olist, **kwargs):
@@ -256,96 +481,215 @@ def as_list(func):
     return wrapper
 
 
-def filter_query_with_key(query, keyword, value, op):
-    if '.' in keyword:
-        class_name = keyword.partition('.')[0]
-        attr_name = keyword.partition('.')[2]
-        model_class = getattr(models, class_name)
-        _query = query.join(model_class)
-    else:
-        model_class = query.cls
-        attr_name = keyword
-        _query = query
-    if hasattr(model_class, attr_name):
-        key = getattr(model_class, attr_name)
-        if op == '~':
-            value = "%{0}%".format(value)
-        return _query.filter(getattr(
-            key, OPERATOR_FUNC[op])(value))
-    else:
-        return query
-
+# Two character operators first, so that a '>=5' is not taken for a '>'
+# on '=5'
+_OPERATORS_BY_LENGTH = sorted(OPERATORS, key=len, reverse=True)
+
+# (model class, filter signature) => compiled filters
+_COMPILED_FILTERS = LRUCache(maxsize=512)
+
+
+def parse_filters(args):
+    """
+    Parses the filtering part of a query string into a list of
+    (keyword, op, value, implicit) tuples. The operator is taken from the
+    end of the key, as in `total_cost>=10`, which arrives as the key
+    `total_cost>` with the value `10` and means '>', or from the start of
+    the value, as in `total_cost=>=10`. Keys without an operator are
+    `implicit` equality filters, where 'none' means NULL.
+    """
+    filters = []
+    for kw in args:
+        if kw in RESTRICTED:
+            continue
+        value = args.get(kw)
+        for op in _OPERATORS_BY_LENGTH:
+            if kw.endswith(op):
+                filters.append((kw[:-len(op)], op, value, False))
+                break
+        else:
+            for op in _OPERATORS_BY_LENGTH:
+                if value.startswith(op):
+                    filters.append((kw, op, value[len(op):], False))
+                    break
+            else:
+                filters.append((
+                    kw, '=', None if value.lower() == 'none' else value,
+                    True))
+    return filters
+
+
+def compile_filters(cls, signature):
+    """
+    Resolves a filter signature, a tuple of (keyword, op) pairs, against
+    a model class. Returns the related classes to join, each once, and
+    one (attribute, operator function) pair per filter, or None for a
+    filter on an attribute which does not exist and is ignored.
+    """
+    joins = []
+    comparisons = []
+    for keyword, op in signature:
+        if '.' in keyword:
+            class_name, _, attr_name = keyword.partition('.')
+            model_class = getattr(models, class_name, None)
+        else:
+            model_class, attr_name = cls, keyword
+        if model_class is None or not hasattr(model_class, attr_name):
+            comparisons.append(None)
+            continue
+        if model_class is not cls and model_class not in joins:
+            joins.append(model_class)
+        comparisons.append(
+            (getattr(model_class, attr_name), OPERATOR_FUNC[op]))
+    return (joins, comparisons)
+
+
+def apply_filters(query, filters):
+    signature = tuple((keyword, op) for keyword, op, v, i in filters)
+    key = (query.cls, signature)
+    compiled = _COMPILED_FILTERS.get(key)
+    if compiled is None:
+        compiled = compile_filters(query.cls, signature)
+        _COMPILED_FILTERS.set(key, compiled)
+    joins, comparisons = compiled
+    for model_class in joins:
+        query = query.join(model_class)
+    criteria = []
+    for comparison, (keyword, op, value, implicit) in zip(
+            comparisons, filters):
+        if comparison is not None:
+            attr, operator_func = comparison
+            if op == '~':
+                value = "%{0}%".format(value)
+            criteria.append(getattr(attr, operator_func)(value))
+    return query.filter(*criteria) if criteria else query
+
+
+def page_total(query, count_mode='exact'):
+    """
+    The total number of rows in a paginated query, and whether it is an
+    estimate. `exact` counts them (cached per query in count_cache),
+    `estimate` asks the db statistics and falls back to `exact` where
+    there are none, and `none` returns None without touching the db.
+    """
+    if count_mode == 'none':
+        return (None, False)
+    if count_mode == 'estimate':
+        total = estimated_count(query)
+        if total is not None:
+            return (total, True)
+    return (count_cache.count(query), False)
+
+
+def as_processed_list(func=None, stream=False):
+    """
+    Can be used both as `@as_processed_list` and as
+    `@as_processed_list(stream=True)`. A streamed endpoint (or any request
+    with `stream=true` in the query string) writes out its rows as they
+    are fetched instead of building the whole response in memory.
+    """
+    if func is None:
+        return partial(as_processed_list, stream=stream)
+
+    func_args = inspect.getargspec(func).args
 
-def as_processed_list(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
+        stream_result = stream or boolify(request.args.get('stream', 'false'))
+        columnar = request.args.get('format') == 'columns'
+        count_mode = request.args.get('count', 'exact')
+        if count_mode not in COUNT_MODES:
+            abort(400, 'count should be one of %s' % ', '.join(COUNT_MODES))
         limit = request.args.get('limit', None)
         sort = request.args.get('sort', None)
         orderby = request.args.get('orderby', 'id')
         offset = request.args.get('offset', None)
         page = request.args.get('page', None)
         per_page = request.args.get('per_page', 20)
-        func_argspec = inspect.getargspec(func)
-        func_args = func_argspec.args
-        for kw in request.args:
-            if (kw in func_args and kw not in RESTRICTED and
-                    not any(request.args.get(kw).startswith(op)
-                            for op in OPERATORS)
-                    and not any(kw.endswith(op) for op in OPERATORS)):
-                kwargs[kw] = request.args.get(kw)
+        filters = parse_filters(request.args)
+        for keyword, op, value, implicit in filters:
+            if implicit and keyword in func_args:
+                kwargs[keyword] = request.args.get(keyword)
         result = func(*args, **kwargs)
         if not isinstance(result, QueryPlus):
             result = result.query
-        for kw in request.args:
-            for op in OPERATORS:
-                if kw.endswith(op):
-                    result = filter_query_with_key(
-                        result, kw.rstrip(op), request.args.get(kw), op)
-                    break
-                elif request.args.get(kw).startswith(op):
-                    result = filter_query_with_key(
-                        result, kw, request.args.get(kw).lstrip(op), op)
-                    break
-            else:
-                # Well who would've thought that a for else will be appropriate
-                # anywhere? Turns out it is here.
-                if kw not in RESTRICTED:
-                    value = request.args.get(kw)
-                    if value.lower() == 'none':
-                        value = None
-                    result = filter_query_with_key(result, kw, value, '=')
-                    # result = result.filter(
-                    #     getattr(result.cls, kw) == value)
-        if sort:
+        result = apply_filters(result, filters)
+        # A client which sends validators for rows of a model with a
+        # _last_modified_attr_ is checked with an aggregate query, and
+        # answered before anything is serialized if it has them already.
+        # Its response carries the aggregate ETag for next time. Every
+        # other response gets its ETag from hashing the body in as_json.
+        etag, last_modified = (None, None)
+        if _is_conditional_request() and _has_validators():
+            etag, last_modified = query_validators(
+                result, **_serializable_params(request.args))
+            if etag is not None and is_not_modified(etag, last_modified):
+                return set_validators(
+                    Response(status=304), etag, last_modified)
+        cursor_mode = 'after' in request.args
+        if sort and not cursor_mode:
             if sort == 'asc':
                 result = result.asc(orderby)
             elif sort == 'desc':
                 result = result.desc(orderby)
-        if page:
-            pagination = result.paginate(int(page), int(per_page))
-            if pagination.total == 0:
-                return as_json_list(
-                    result,
-                    **_serializable_params(request.args, check_groupby=True))
-            if int(page) > pagination.pages:
+        if not stream_result:
+            # Streamed rows get their relationships loaded batch by batch
+            result = result.eager_load(**_serializable_params(request.args))
+        params = _serializable_params(request.args, check_groupby=True)
+        if cursor_mode:
+            # Keyset pagination. `after` is the opaque cursor of the last
+            # row of the previous page (empty for the first page). One
+            # extra row is fetched to know if there is a next page.
+            sort = sort or 'asc'
+            size = int(limit or per_page)
+            rows = result.seek(
+                decode_cursor(request.args.get('after'), orderby, sort),
+                attr=orderby, descending=sort == 'desc').limit(
+                size + 1).all()
+            next_cursor = (encode_cursor(orderby, sort, rows[size - 1])
+                           if len(rows) > size else None)
+            response = as_json_list(
+                rows[:size], columnar=columnar,
+                **add_kv_to_dict(params, 'meta', {'next_cursor': next_cursor}))
+        elif page:
+            page = int(page)
+            per_page = int(per_page)
+            if page < 1:
                 abort(404)
-            return as_json_list(
-                pagination.items,
-                **add_kv_to_dict(
-                    _serializable_params(request.args, check_groupby=True),
-                    'meta', {'total_pages': pagination.pages,
-                             'total_items': pagination.total
-                             }))
+            total, is_estimate = page_total(result, count_mode)
+            if total == 0 and count_mode == 'exact':
+                response = as_json_list([], **params)
+            else:
+                pages = (int(ceil(total / float(per_page)))
+                         if total is not None else None)
+                if pages is not None and page > pages and (
+                        count_mode == 'exact'):
+                    abort(404)
+                items = result.limit(per_page).offset(
+                    (page - 1) * per_page).all()
+                if len(items) == 0 and page > 1:
+                    abort(404)
+                meta = {}
+                if total is not None:
+                    meta = {'total_pages': pages, 'total_items': total}
+                    if is_estimate:
+                        meta['total_is_estimate'] = True
+                response = as_json_list(
+                    items, stream=stream_result, columnar=columnar,
+                    **add_kv_to_dict(params, 'meta', meta))
         else:
             if limit:
                 result = result.limit(limit)
             if offset:
                 result = result.offset(int(offset)-1)
-            result = result.all()
-        return as_json_list(
-            result,
-            **_serializable_params(request.args, check_groupby=True)
-            )
+            if not stream_result and not columnar:
+                result = result.all()
+            response = as_json_list(
+                result, stream=stream_result, columnar=columnar,
+                **params)
+        if etag is not None:
+            set_validators(response, etag, last_modified)
+        return response
     return wrapper
 
 
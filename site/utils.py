@@ -5,6 +5,8 @@
 
 from itertools import chain, groupby
 from operator import attrgetter
+from collections import OrderedDict
+from threading import Lock
 from contextlib import contextmanager
 from inspect import ismethod
 import re
@@ -12,6 +14,7 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 import uuid
 import os
+import time
 from werkzeug.utils import secure_filename
 import math
 from flask import current_app
@@ -30,22 +33,118 @@ EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
 CUBIC_INCHES_IN_CUBIC_FEET = 12 * 12 * 12
 
 
+LIST_LIKE_TYPES = (list, _AssociationList, InstrumentedList)
+
+DICT_LIKE_TYPES = (dict, _AssociationDict, MappedCollection)
+
+
 def is_list_like(rel_instance):
-    return (isinstance(rel_instance, list) or isinstance(
-        rel_instance, _AssociationList) or isinstance(
-        rel_instance, InstrumentedList))
+    return isinstance(rel_instance, LIST_LIKE_TYPES)
 
 
 def is_dict_like(rel_instance):
-    return (isinstance(rel_instance, dict) or isinstance(
-        rel_instance, _AssociationDict) or isinstance(
-        rel_instance, MappedCollection))
+    return isinstance(rel_instance, DICT_LIKE_TYPES)
 
 
 class TimeoutError(Exception):
     pass
 
 
+class LRUCache(object):
+    """
+    A small thread safe mapping which discards the least recently used
+    entry once it holds more than `maxsize` entries. With a `ttl` (in
+    seconds), entries also expire that long after they were set.
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.set('a', 1); cache.set('b', 2); cache.set('c', 3)
+    >>> cache.get('a') is None
+    True
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at < time.time():
+                return default
+            self._data[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """A snapshot of the (key, value) pairs which have not expired"""
+        now = time.time()
+        with self._lock:
+            return [(k, value) for k, (expires_at, value)
+                    in self._data.items()
+                    if expires_at is None or expires_at >= now]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (
+                entry[0] is None or entry[0] >= time.time())
+
+    def __len__(self):
+        return len(self._data)
+
+
+class OrderedIdentitySet(object):
+    """
+    A set which keeps its items in insertion order and tells them apart by
+    identity, not equality, so that adding and checking are O(1) for any
+    item, hashable or not.
+    """
+
+    def __init__(self, items=()):
+        self._items = OrderedDict()
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self._items.setdefault(id(item), item)
+
+    def discard(self, item):
+        self._items.pop(id(item), None)
+
+    def pop(self):
+        return self._items.popitem()[1]
+
+    def __contains__(self, item):
+        return id(item) in self._items
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+
 def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
     def decorator(func):
         def _handle_timeout(signum, frame):
@@ -380,6 +479,12 @@ def deep_group(olist, keys, sort_attr=None, serializer=None,
     """
     if len(keys) == 0:
         return olist
+    if serializer and not callable(serializer):
+        # A method name like 'todict'. Bind it once here so that the
+        # recursive calls and the leaf loops can treat both forms alike.
+        method_name = serializer
+        serializer = lambda item: getattr(item, method_name)(
+            *serializer_args, **serializer_kwargs)
     if sort_attr:
         olist.sort(key=attrgetter(sort_attr))
     result = {}
@@ -388,9 +493,7 @@ def deep_group(olist, keys, sort_attr=None, serializer=None,
         if len(keys) == 1:
             if strip_single_object_lists and len(items) == 1:
                 if serializer:
-                    result[k] = getattr(
-                        items[0], serializer)(*serializer_args,
-                                              **serializer_kwargs)
+                    result[k] = serializer(items[0])
                 elif attr_to_show:
                     result[k] = getattr(
                         items[0], attr_to_show)
@@ -398,10 +501,7 @@ def deep_group(olist, keys, sort_attr=None, serializer=None,
                     result[k] = items[0]
             else:
                 if serializer:
-                    result[k] = [getattr(
-                        item, serializer)(*serializer_args,
-                                          **serializer_kwargs)
-                        for item in items]
+                    result[k] = [serializer(item) for item in items]
                 elif attr_to_show:
                     result[k] = [getattr(
                         item, attr_to_show) for item in items]
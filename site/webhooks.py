@@ -0,0 +1,142 @@
+"""
+Delivers outbound webhooks after the transaction which fired them has
+committed, off the request thread.
+"""
+import logging
+from threading import Thread, Lock
+from Queue import Queue, Full
+from time import sleep, time
+from sqlalchemy import event
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class WebhookDispatcher(object):
+    """
+    Hooks are queued on the session with `enqueue` while a transaction is
+    open, and handed to a bounded pool of worker threads once it commits.
+    A rollback drops them, so nothing is sent for writes which did not
+    happen, and the rollback of a savepoint drops those queued since it
+    began.
+
+    A hook is a function and its args. It runs inside an app context, so
+    it can load what it needs with its own session, and should be given
+    ids rather than instances. `post` sends json through a shared http
+    session which pools connections per host and times out.
+
+    Hooks which raise are retried with exponential backoff.
+    """
+
+    def __init__(self, workers=4, queue_size=1000, timeout=5,
+                 max_retries=3, backoff=1):
+        self.app = None
+        self.workers = workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = Queue(maxsize=queue_size)
+        self.http = requests.Session()
+        self._mount_adapters()
+        self.logger = logging.getLogger(__name__)
+        self._threads = []
+        self._lock = Lock()
+        self.metrics = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0,
+                        'dropped': 0, 'discarded': 0, 'seconds': 0.0}
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('WEBHOOK_WORKERS', self.workers)
+        self.timeout = app.config.get('WEBHOOK_TIMEOUT', self.timeout)
+        self.max_retries = app.config.get(
+            'WEBHOOK_MAX_RETRIES', self.max_retries)
+        self.backoff = app.config.get('WEBHOOK_BACKOFF', self.backoff)
+        # A connection per worker, so that none of them waits on the pool
+        self._mount_adapters()
+
+    def _mount_adapters(self):
+        self.http.mount('http://', HTTPAdapter(pool_maxsize=self.workers))
+        self.http.mount('https://', HTTPAdapter(pool_maxsize=self.workers))
+
+    def listen(self, session_cls):
+        event.listen(session_cls, 'after_commit', self._dispatch)
+        event.listen(session_cls, 'after_soft_rollback', self._discard)
+
+    def enqueue(self, session, func, *args):
+        """Sends `func(*args)` once the transaction of `session` commits"""
+        session.record('webhooks', (func, args), unique=False)
+
+    def post(self, url, payload, **kwargs):
+        """Posts `payload` as json and raises on an error status"""
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.http.post(url, json=payload, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def _dispatch(self, session):
+        # Releasing a savepoint commits nothing yet
+        if session.transaction.nested:
+            return
+        for func, args in session.pop_record('webhooks'):
+            self.submit(func, args)
+
+    def _discard(self, session, previous_transaction):
+        # The hooks are dropped with the rest of the changes of the
+        # session, and taken back to a savepoint on its rollback
+        if previous_transaction.parent is None:
+            self.metrics['discarded'] += len(
+                session.recorded('webhooks') or [])
+
+    def submit(self, func, args=()):
+        self._start_workers()
+        try:
+            self.queue.put_nowait((func, args, 0))
+            self.metrics['queued'] += 1
+        except Full:
+            self.metrics['dropped'] += 1
+            self.logger.error('Webhook queue full, dropped %s%r',
+                              func.__name__, args)
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(self.workers - len(self._threads)):
+                thread = Thread(target=self._work, name='webhooks-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, attempt = self.queue.get()
+            try:
+                self._deliver(func, args, attempt)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, func, args):
+        start = time()
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    func(*args)
+            else:
+                func(*args)
+        finally:
+            self.metrics['seconds'] += time() - start
+
+    def _deliver(self, func, args, attempt):
+        try:
+            self._run(func, args)
+            self.metrics['sent'] += 1
+        except Exception:
+            if attempt < self.max_retries:
+                self.metrics['retried'] += 1
+                sleep(self.backoff * 2 ** attempt)
+                self._deliver(func, args, attempt + 1)
+            else:
+                self.metrics['failed'] += 1
+                self.logger.exception('Webhook %s%r failed after %d tries',
+                                      func.__name__, args, attempt + 1)
+
+
+webhooks = WebhookDispatcher()
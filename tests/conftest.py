@@ -0,0 +1,49 @@
+import pytest
+import fakeredis
+from flask import Flask
+from site.flask_client_plus import FlaskClientPlus
+from site.models.caching import (serialized_cache, count_cache, query_cache,
+                                 LocalBackend)
+from .models import db
+
+
+def make_app(tmpdir, **config):
+    app = Flask(__name__)
+    app.test_client_class = FlaskClientPlus
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % tmpdir.join(
+        'primary.db')
+    app.config.update(config)
+    db.init_app(app)
+    return app
+
+
+@pytest.fixture
+def app(tmpdir):
+    app = make_app(tmpdir)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def session(app):
+    return db.session
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    serialized_cache.clear()
+    count_cache.counts.clear()
+    query_cache.regions = {'default': LocalBackend()}
+    query_cache.hits = query_cache.misses = 0
+    yield
+
+
+
+@pytest.fixture
+def redis():
+    redis = fakeredis.FakeStrictRedis()
+    redis.flushall()
+    return redis
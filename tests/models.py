@@ -0,0 +1,92 @@
+"""
+Models of the tests. They live on a db of their own, so that the tests do
+not need the tables of the app.
+"""
+from datetime import datetime
+from site.models.core import SQLAlchemyPlus
+
+db = SQLAlchemyPlus()
+
+
+order_tags = db.Table(
+    'order_tags',
+    db.Column('order_id', db.Integer, db.ForeignKey('orders.id')),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id')))
+
+
+class User(db.Model):
+    __tablename__ = 'users'
+    _attrs_to_serialize_ = ['id', 'email', 'name']
+    _last_modified_attr_ = 'updated_at'
+
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120, collation='NOCASE'), unique=True)
+    name = db.Column(db.String(120))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    orders = db.relationship('Order', backref='user')
+
+
+class Order(db.Model):
+    __tablename__ = 'orders'
+    _attrs_to_serialize_ = ['id', 'user_id', 'status', 'total', 'shipped_at']
+    _rels_to_serialize_ = [('items', 'id')]
+    _last_modified_attr_ = 'updated_at'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    status = db.Column(db.String(20), default='in-queue')
+    total = db.Column(db.Numeric(10, 2))
+    shipped_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+    items = db.relationship('Item', backref='order')
+    tags = db.relationship('Tag', secondary=order_tags)
+
+
+class Item(db.Model):
+    __tablename__ = 'items'
+    _attrs_to_serialize_ = ['id', 'order_id', 'sku', 'quantity']
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    sku = db.Column(db.String(40))
+    quantity = db.Column(db.Integer, default=1)
+
+
+class Tag(db.Model):
+    __tablename__ = 'tags'
+    _attrs_to_serialize_ = ['id', 'name']
+    _rels_to_serialize_ = [('orders', 'id')]
+    _cache_serialized_ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(40), unique=True)
+    # The other side of Order.tags, without a backref, so that adding a
+    # tag to an order does not touch the tag
+    orders = db.relationship('Order', secondary=order_tags)
+
+
+class Payment(db.Model):
+    __tablename__ = 'payments'
+    _attrs_to_serialize_ = ['id', 'kind', 'amount']
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))
+    amount = db.Column(db.Numeric(10, 2))
+    __mapper_args__ = {'polymorphic_on': kind,
+                       'polymorphic_identity': 'payment'}
+
+
+class CardPayment(Payment):
+    __mapper_args__ = {'polymorphic_identity': 'card'}
+    _attrs_to_serialize_ = ['id', 'kind', 'amount', 'card_last4']
+
+    card_last4 = db.Column(db.String(4))
+
+
+class WalletPayment(Payment):
+    __mapper_args__ = {'polymorphic_identity': 'wallet'}
+    _attrs_to_serialize_ = ['id', 'kind', 'wallet', 'amount']
+
+    wallet = db.Column(db.String(20))
@@ -0,0 +1,189 @@
+import pytest
+from site.models.caching import serialized_cache, query_cache, RedisBackend
+from site.models.instrumentation import sql_instrumentation
+from .models import Order, Item, Tag
+
+
+@pytest.fixture
+def shared_redis(redis):
+    serialized_cache.shared = redis
+    yield redis
+    serialized_cache.shared = None
+
+
+def add_tags(session, *names):
+    tags = [Tag(name=name) for name in names]
+    session.add_all(tags)
+    session.commit()
+    return tags
+
+
+def shared_keys(redis):
+    return set(k for k in redis.keys('serialized:*')
+               if not k.startswith('serialized:deps:'))
+
+
+def test_cached_dicts_are_copies(app, session):
+    tag, = add_tags(session, 'gift')
+    tag.orders.append(Order())
+    session.commit()
+    tag.todict()['orders'].append(42)
+    assert len(tag.todict()['orders']) == 1
+
+
+def test_adding_to_a_secondary_collection_invalidates(app, session):
+    tag, = add_tags(session, 'gift')
+    assert tag.todict()['orders'] == []
+    order = Order()
+    session.add(order)
+    session.commit()
+    # Only the order is dirty, the tag is reached through order_tags
+    order.tags.append(tag)
+    session.commit()
+    assert tag.todict()['orders'] == [order.id]
+    order.tags.remove(tag)
+    session.commit()
+    assert tag.todict()['orders'] == []
+
+
+def test_reads_outside_writes_go_to_the_shared_tier(
+        app, session, shared_redis):
+    tag, = add_tags(session, 'gift')
+    tag.todict()
+    assert len(shared_keys(shared_redis)) == 1
+
+
+def test_shared_tier_waits_for_the_commit(app, session, shared_redis):
+    gift, sale = add_tags(session, 'gift', 'sale')
+    gift.orders.append(Order())
+    session.flush()
+    gift.todict()
+    sale.todict()
+    assert shared_keys(shared_redis) == set()
+    session.commit()
+    # The gift was written by the transaction, its dict is not shared
+    assert shared_keys(shared_redis) == set(
+        [serialized_cache._key(Tag.serialization_plan(), 'Tag:%d' % sale.id)])
+
+
+def test_shared_tier_skips_rolled_back_reads(app, session, shared_redis):
+    gift, sale = add_tags(session, 'gift', 'sale')
+    gift.name = 'gifts'
+    session.flush()
+    sale.todict()
+    session.rollback()
+    assert shared_keys(shared_redis) == set()
+
+
+def test_released_savepoints_keep_dicts_uncommitted(
+        app, session, shared_redis):
+    gift, = add_tags(session, 'gift')
+    gift.name = 'uncommitted'
+    session.flush()
+    session.begin_nested()
+    session.commit()
+    assert gift.todict()['name'] == 'uncommitted'
+    assert shared_keys(shared_redis) == set()
+    session.rollback()
+    assert gift.todict()['name'] == 'gift'
+
+
+def test_lookup_memo(app, session):
+    gift, = add_tags(session, 'gift')
+    gift_id = gift.id
+    session.expunge_all()
+    with sql_instrumentation.record() as queries:
+        gift = Tag.first(name='gift')
+        assert Tag.first(name='gift') is gift
+        assert Tag.first(id=gift_id) is gift
+    assert queries.count == 2
+
+
+def test_lookup_memo_skips_misses(app, session):
+    assert Tag.first(name='gift') is None
+    session.execute(Tag.__table__.insert().values(name='gift'))
+    assert Tag.first(name='gift') is not None
+
+
+def test_lookup_memo_ends_with_the_transaction(app, session):
+    add_tags(session, 'gift')
+    gift = Tag.first(name='gift')
+    session.execute(Tag.__table__.update().values(name='gifts'))
+    session.commit()
+    assert Tag.first(name='gift') is None
+    assert Tag.first(name='gifts') is gift
+
+
+def test_lookup_memo_drops_expunged_objects(app, session):
+    add_tags(session, 'gift')
+    gift = Tag.first(name='gift')
+    session.expunge(gift)
+    found = Tag.first(name='gift')
+    assert found is not gift and found in session
+
+
+def test_lookup_memo_skips_classes_with_pending_changes(app, session):
+    gift, = add_tags(session, 'gift')
+    assert Tag.first(name='gift') is gift
+    # New objects of other classes leave the memo on
+    session.add(Item(sku='A'))
+    with sql_instrumentation.record() as queries:
+        assert Tag.first(name='gift') is gift
+    assert queries.count == 0
+    # A new tag could be the one looked up, so the lookup autoflushes
+    session.add(Tag(name='sale'))
+    with sql_instrumentation.record() as queries:
+        assert Tag.first(name='gift') is gift
+    assert queries.count > 0
+    gift.name = 'gifts'
+    assert Tag.first(name='gift') is None
+    assert Tag.first(name='gifts') is gift
+    session.delete(gift)
+    assert Tag.first(name='gifts') is None
+
+
+@pytest.fixture(params=['default', 'redis'])
+def region(request, redis):
+    query_cache.add_region('redis', RedisBackend(redis))
+    return request.param
+
+
+def cached_skus(region):
+    return sorted(i.sku for i in Item.query.cached(region=region))
+
+
+def test_query_cache_sees_bulk_updates(app, session, region):
+    session.add_all([Item(sku='A'), Item(sku='B')])
+    session.commit()
+    assert cached_skus(region) == ['A', 'B']
+    assert cached_skus(region) == ['A', 'B']
+    assert query_cache.hits == 1
+    Item.query.filter(Item.sku == 'B').update(
+        {'sku': 'C'}, synchronize_session=False)
+    session.commit()
+    session.expunge_all()
+    assert cached_skus(region) == ['A', 'C']
+    Item.query.filter(Item.sku == 'A').delete(synchronize_session=False)
+    session.commit()
+    assert cached_skus(region) == ['C']
+
+
+def test_query_cache_sees_fast_inserts(app, session, region):
+    assert cached_skus(region) == []
+    Item.create_all([{'sku': 'A'}, {'sku': 'B'}], fast=True)
+    assert cached_skus(region) == ['A', 'B']
+    Item.create_all([{'sku': 'C'}], fast=True, commit=False)
+    assert cached_skus(region) == ['A', 'B', 'C']
+    session.rollback()
+    assert cached_skus(region) == ['A', 'B']
+
+
+def test_query_cache_waits_for_the_outermost_commit(app, session, region):
+    session.add(Item(sku='A'))
+    session.flush()
+    session.begin_nested()
+    session.commit()
+    skus = Item.query.with_entities(Item.sku).cached(region=region)
+    assert skus.all() == [('A',)]
+    session.rollback()
+    assert skus.all() == []
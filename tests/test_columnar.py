@@ -0,0 +1,41 @@
+from decimal import Decimal
+from site.responses import columnar_list
+from .models import Payment, CardPayment, WalletPayment, Item
+
+
+def add_payments(session):
+    session.add_all([
+        Payment(amount=Decimal('5.00')),
+        CardPayment(amount=Decimal('10.00'), card_last4='4242'),
+        WalletPayment(amount=Decimal('20.00'), wallet='paytm')])
+    session.commit()
+
+
+def test_columns_of_every_class_in_a_polymorphic_list(app, session):
+    add_payments(session)
+    result = columnar_list(Payment.query.order_by(Payment.id))
+    assert result['columns'] == [
+        'id', 'kind', 'amount', 'card_last4', 'wallet']
+    rows = [dict(zip(result['columns'], row)) for row in result['rows']]
+    assert rows[1]['card_last4'] == '4242'
+    assert rows[2]['wallet'] == 'paytm'
+    assert rows[2]['amount'] == Decimal('20.00')
+    assert rows[0]['card_last4'] is None and rows[0]['wallet'] is None
+
+
+def test_columns_of_a_list_of_objects(app, session):
+    add_payments(session)
+    payments = Payment.query.order_by(Payment.id.desc()).all()
+    result = columnar_list(payments)
+    assert result['columns'] == [
+        'id', 'kind', 'wallet', 'amount', 'card_last4']
+    assert result['rows'][0][2] == 'paytm'
+    assert result['rows'][1][4] == '4242'
+
+
+def test_plain_columns_are_selected_without_objects(app, session):
+    session.add_all([Item(sku='A', quantity=2), Item(sku='B')])
+    session.commit()
+    result = columnar_list(Item.query.order_by(Item.id))
+    assert result == {'columns': ['id', 'order_id', 'sku', 'quantity'],
+                      'rows': [[1, None, 'A', 2], [2, None, 'B', 1]]}
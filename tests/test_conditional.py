@@ -0,0 +1,50 @@
+import pytest
+from site.responses import as_processed_list
+from site.models.instrumentation import sql_instrumentation
+from .models import User, Order, Item
+from .test_serialization import add_users
+
+
+@pytest.fixture
+def client(app, session):
+    app.add_url_rule('/users', 'users', as_processed_list(lambda: User))
+    app.add_url_rule('/orders', 'orders', as_processed_list(lambda: Order))
+    add_users(session)
+    return app.test_client()
+
+
+def aggregates(queries):
+    return [s for s in queries.statements if 'max(' in s]
+
+
+def test_plain_gets_skip_the_aggregate(client):
+    with sql_instrumentation.record() as queries:
+        response = client.get('/users')
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    assert aggregates(queries) == []
+
+
+def test_validators_converge_on_the_aggregate_etag(client):
+    body_etag = client.get('/users').headers['ETag']
+    response = client.get('/users', headers={'If-None-Match': body_etag})
+    assert response.status_code == 304
+    aggregate_etag = response.headers['ETag']
+    assert aggregate_etag != body_etag
+    with sql_instrumentation.record() as queries:
+        response = client.get(
+            '/users', headers={'If-None-Match': aggregate_etag})
+    assert response.status_code == 304
+    assert queries.count == 1 and len(aggregates(queries)) == 1
+
+
+def test_changed_related_rows_change_the_etag(client, session):
+    url = '/orders?expand=items'
+    etag = client.get(url).headers['ETag']
+    etag = client.get(url, headers={'If-None-Match': etag}).headers['ETag']
+    item = Item.query.first()
+    item.sku = 'CHANGED'
+    session.commit()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'CHANGED' in response.data
@@ -0,0 +1,50 @@
+import json
+import pytest
+from site.responses import as_processed_list
+from site.models.caching import count_cache
+from .models import Order
+from .test_serialization import add_users
+
+
+@pytest.fixture
+def client(app, session):
+    app.add_url_rule('/orders', 'orders', as_processed_list(lambda: Order))
+    add_users(session)
+    return app.test_client()
+
+
+def test_bulk_writes_invalidate_counts(app, session):
+    add_users(session)
+    shipped = Order.query.filter(Order.status == 'shipped')
+    assert count_cache.count(shipped) == 0
+    Order.query.filter(Order.id <= 2).update(
+        {'status': 'shipped'}, synchronize_session=False)
+    session.commit()
+    assert count_cache.count(shipped) == 2
+    Order.query.filter(Order.id == 1).delete(synchronize_session=False)
+    session.commit()
+    assert count_cache.count(shipped) == 1
+
+
+def test_estimate_flag_only_for_estimates(client, session):
+    response = client.get('/orders?page=1&count=estimate')
+    assert 'total_is_estimate' not in response.data
+    assert json.loads(response.data)['total_items'] == 6
+    session.execute('ANALYZE')
+    session.commit()
+    response = client.get('/orders?page=1&count=estimate')
+    meta = json.loads(response.data)
+    assert meta['total_is_estimate'] is True
+
+
+def test_counts_see_the_writes_of_the_transaction(app, session):
+    shipped = Order.query.filter(Order.status == 'shipped')
+    assert count_cache.count(shipped) == 0
+    session.add(Order(status='shipped'))
+    session.flush()
+    assert count_cache.count(shipped) == 1
+    session.begin_nested()
+    session.commit()
+    assert count_cache.count(shipped) == 1
+    session.rollback()
+    assert count_cache.count(shipped) == 0
@@ -0,0 +1,37 @@
+from sqlalchemy import event
+from site.models.instrumentation import sql_instrumentation
+from .models import Item, Order
+
+
+def test_fast_path_inserts_in_one_statement(app, session):
+    assert not Item._has_orm_listeners()
+    with sql_instrumentation.record() as queries:
+        items = Item.create_all(
+            [{'sku': 'SKU%d' % i, 'quantity': i} for i in range(50)],
+            fast=True, commit=False)
+    inserts = [s for s in queries.statements if s.startswith('INSERT')]
+    assert len(inserts) == 1
+    assert [(i.sku, i.quantity) for i in items] == [
+        ('SKU%d' % i, i) for i in range(50)]
+
+
+def test_models_with_listeners_take_the_orm_path(app, session):
+    def set_status(order, *args):
+        order.status = 'new'
+    event.listen(Order, 'init', set_status)
+    try:
+        assert Order._has_orm_listeners()
+        orders = Order.create_all([{}, {}], fast=True)
+        assert [o.status for o in orders] == ['new', 'new']
+    finally:
+        event.remove(Order, 'init', set_status)
+
+
+def test_ids_without_loading(app, session):
+    with sql_instrumentation.record() as queries:
+        ids = Item.create_all([{'sku': 'A'}, {'sku': 'B'}], fast=True,
+                              load=False)
+    assert not any(s.startswith('SELECT') for s in queries.statements)
+    assert [Item.get(i).sku for i in ids] == ['A', 'B']
+    order_ids = Order.create_all([{}, {}], load=False)
+    assert [Order.get(i).id for i in order_ids] == order_ids
@@ -0,0 +1,42 @@
+import json
+from base64 import urlsafe_b64encode
+import pytest
+from site.responses import as_processed_list
+from .models import Order
+from .test_seek import orders, SHIPPED
+
+
+@pytest.fixture
+def client(app, orders):
+    app.add_url_rule('/orders', 'orders', as_processed_list(lambda: Order))
+    return app.test_client()
+
+
+def cursor(*parts):
+    return urlsafe_b64encode(json.dumps(list(parts)))
+
+
+def test_cursors_page_through_every_row(client):
+    seen = []
+    after = ''
+    while after is not None:
+        response = client.get(
+            '/orders?orderby=shipped_at&limit=2&after=%s' % after)
+        body = json.loads(response.data)
+        seen.extend(o['id'] for o in body['result'])
+        after = body['next_cursor']
+    assert sorted(seen) == range(1, len(SHIPPED) + 1)
+
+
+@pytest.mark.parametrize('orderby,after', [
+    ('shipped_at', 'garbage'),
+    ('shipped_at', cursor('shipped_at', 'asc', '2016-01-01T00:00:00', 1, 2)),
+    ('shipped_at', cursor('shipped_at', 'asc', 'yesterday', 1)),
+    ('shipped_at', cursor('shipped_at', 'asc', '2016-01-01T00:00:00', 'one')),
+    ('shipped_at', cursor('shipped_at', 'asc', {'a': 1}, 1)),
+    ('shipped_at', cursor('id', 'asc', 1, 1)),
+    ('total', cursor('total', 'asc', 'ten', 1)),
+])
+def test_bad_cursors_are_bad_requests(client, orderby, after):
+    response = client.get('/orders?orderby=%s&after=%s' % (orderby, after))
+    assert response.status_code == 400
@@ -0,0 +1,41 @@
+from decimal import Decimal
+from site.responses import parse_filters, apply_filters
+from flask import request
+from .models import Order
+
+
+def filters_of(app, query_string):
+    with app.test_request_context('/orders?' + query_string):
+        return sorted(parse_filters(request.args))
+
+
+def test_wire_form_of_comparisons(app):
+    assert filters_of(app, 'total>=10&id<=3') == [
+        ('id', '<', '3', False), ('total', '>', '10', False)]
+    assert filters_of(app, 'status!=shipped&status~=ship') == [
+        ('status', '!', 'shipped', False), ('status', '~', 'ship', False)]
+
+
+def test_operators_in_values(app):
+    assert filters_of(app, 'total=>10') == [('total', '>', '10', False)]
+    assert filters_of(app, 'total=>=10') == [('total', '>=', '10', False)]
+    assert filters_of(app, 'total=<10') == [('total', '<', '10', False)]
+
+
+def test_encoded_operators_in_keys(app):
+    assert filters_of(app, 'total%3E%3D=10') == [
+        ('total', '>=', '10', False)]
+
+
+def test_implicit_filters(app):
+    assert filters_of(app, 'status=none&limit=5&user_id=2') == [
+        ('status', '=', None, True), ('user_id', '=', '2', True)]
+
+
+def test_filtering_with_the_wire_form(app, session):
+    session.add_all([Order(total=Decimal(t)) for t in ('5', '10', '15')])
+    session.commit()
+    with app.test_request_context('/orders?total>=10'):
+        orders = apply_filters(
+            Order.query, parse_filters(request.args)).all()
+    assert [o.total for o in orders] == [Decimal('15')]
@@ -0,0 +1,62 @@
+import pytest
+from site.models import modelbase
+from site.models.instrumentation import sql_instrumentation
+from .models import User, Order
+from .test_serialization import add_users
+
+
+@pytest.fixture
+def users(app, session):
+    add_users(session)
+    return User.query.order_by(User.id).all()
+
+
+def test_order_missing_and_duplicates(users):
+    ids = [users[2].id, 99, users[0].id, users[2].id]
+    assert User.get_all(ids) == [users[2], None, users[0], users[2]]
+    assert User.get_all([]) == []
+
+
+def test_identity_map_hits_skip_the_db(users):
+    with sql_instrumentation.record() as queries:
+        assert User.get_all([u.id for u in users]) == users
+    assert queries.count == 0
+
+
+def test_batches(users, session, monkeypatch):
+    monkeypatch.setattr(modelbase, 'IN_BATCH_SIZE', 2)
+    session.expunge_all()
+    with sql_instrumentation.record() as queries:
+        found = User.get_all([3, 1, 2, 4])
+    assert [u and u.id for u in found] == [3, 1, 2, None]
+    assert queries.count == 2
+
+
+def test_user_id(users):
+    orders = Order.get_all([1, 2, 3], user_id=users[0].id)
+    assert [o and o.user_id for o in orders] == [
+        users[0].id, users[0].id, None]
+
+
+def test_case_insensitive_keys(users, session):
+    session.expunge_all()
+    found = User.get_all(
+        ['USER1@example.com', 'user1@example.com', 'nobody@example.com'],
+        key='email')
+    assert [u and u.id for u in found] == [users[1].id, users[1].id, None]
+    found = User.find_all_by_keys(
+        [{'email': 'User2@Example.com'}, {'email': 'user0@example.com'}],
+        keys=['email'])
+    assert [u.id for u in found] == [users[2].id, users[0].id]
+
+
+def test_case_sensitive_keys(users):
+    assert User.get_all(['User 1', 'USER 1'], key='name') == [users[1], None]
+
+
+def test_mysql_normalizer(app):
+    normalize = modelbase._key_normalizer(Order.status, 'mysql')
+    assert normalize('Shipped  ') == 'shipped'
+    assert normalize(None) is None
+    assert modelbase._key_normalizer(Order.status, 'postgresql') is None
+    assert modelbase._key_normalizer(Order.id, 'mysql') is None
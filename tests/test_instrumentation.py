@@ -0,0 +1,89 @@
+import json
+import logging
+import pytest
+from sqlalchemy.exc import OperationalError
+from site.models.instrumentation import QueryRecord, sql_instrumentation
+from site.responses import as_processed_list
+from .conftest import make_app
+from .models import db, User, Order
+from .test_serialization import add_users
+
+
+@pytest.fixture
+def app(tmpdir):
+    app = make_app(tmpdir, SQL_INSTRUMENTATION=True)
+    app.add_url_rule('/orders', 'orders', as_processed_list(lambda: Order))
+    app.add_url_rule('/users', 'users', as_processed_list(lambda: User))
+    with app.app_context():
+        db.create_all()
+        add_users(db.session)
+        yield app
+        db.session.remove()
+
+
+def test_records_stay_small():
+    record = QueryRecord(max_statements=10)
+    for i in range(1000):
+        record.add('SELECT * FROM users WHERE id = ?', (i,), 0.001)
+    record.add('SELECT 1', (), 0.001)
+    assert record.count == 1001
+    assert len(record.statements) == 10
+    assert len(record.shapes) == 2
+    assert [(sql, count) for sql, count, duration in record.repeated()] == [
+        ('SELECT * FROM users WHERE id = ?', 1000)]
+
+
+def test_same_params_are_not_an_n_plus_one():
+    record = QueryRecord()
+    for i in range(10):
+        record.add('SELECT * FROM users WHERE id = ?', (1,), 0.001)
+    assert record.repeated() == []
+
+
+def test_requests_are_recorded_in_debug_only(tmpdir):
+    app = make_app(tmpdir)
+    assert sql_instrumentation._start_request not in (
+        app.before_request_funcs.get(None, []))
+    app = make_app(tmpdir, DEBUG=True)
+    assert sql_instrumentation._start_request in (
+        app.before_request_funcs[None])
+
+
+def test_expanded_lists_run_a_fixed_number_of_queries(app):
+    client = app.test_client()
+    # The users, their orders and the items of the orders
+    with client.assert_max_queries(3):
+        client.get('/users?expand=orders')
+    with client.assert_max_queries(3):
+        client.get('/orders?expand=items,user')
+
+
+def test_too_many_queries_fail(app):
+    client = app.test_client()
+    with pytest.raises(AssertionError) as error:
+        with client.assert_max_queries(1):
+            for user in User.query.all():
+                user.orders
+    assert '4 queries run, expected at most 1' in str(error.value)
+
+
+def test_streamed_responses_are_counted(app, caplog):
+    client = app.test_client()
+    logger = sql_instrumentation.logger.name
+    with caplog.at_level(logging.DEBUG, logger=logger):
+        response = client.get('/orders?stream=true&expand=items')
+        assert len(json.loads(response.data)['result']) == 6
+    summaries = [json.loads(r.getMessage()) for r in caplog.records
+                 if r.name == logger]
+    assert len(summaries) == 1
+    assert summaries[0]['queries'] >= 2
+
+
+def test_failed_statements_leave_nothing_on_the_connection(app):
+    connection = db.session.connection()
+    with sql_instrumentation.record() as record:
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM no_such_table')
+        connection.execute('SELECT 1')
+    assert 'query_start_time' not in connection.connection.info
+    assert record.count == 1
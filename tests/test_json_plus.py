@@ -0,0 +1,44 @@
+from datetime import datetime
+from decimal import Decimal
+import json
+import pytest
+from site import json_plus
+from site.json_plus import BACKENDS, dumps, loads, use_backend
+
+
+@pytest.fixture
+def restore_backend():
+    active = json_plus.backend
+    yield
+    json_plus.backend = active
+
+
+def test_datetimes_are_iso_strings():
+    assert loads(dumps({'at': datetime(2015, 3, 1, 10, 30)})) == {
+        'at': '2015-03-01T10:30:00'}
+
+
+@pytest.mark.parametrize('name', sorted(BACKENDS))
+def test_decimals_are_strings(name, restore_backend):
+    use_backend(name)
+    assert dumps({'cost': Decimal('10.50')}) == '{"cost": "10.50"}'
+    assert loads(dumps({'cost': Decimal('10.50')}, sort_keys=True)) == {
+        'cost': '10.50'}
+
+
+@pytest.mark.parametrize('name', sorted(BACKENDS))
+def test_kwargs_go_to_the_backend(name, restore_backend):
+    use_backend(name)
+    body = dumps({'b': [1, 2], 'a': datetime(2015, 3, 1)},
+                 indent=2, sort_keys=True)
+    assert body.splitlines()[1].rstrip() == '  "a": "2015-03-01T00:00:00",'
+    assert json.loads(body) == {'a': '2015-03-01T00:00:00', 'b': [1, 2]}
+
+
+def test_registered_encoders_are_used():
+    class Point(object):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+    json_plus.register_encoder(Point, lambda p: [p.x, p.y])
+    assert loads(dumps({'p': Point(1, 2)})) == {'p': [1, 2]}
@@ -0,0 +1,95 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.hybrid import hybrid_property
+from site.models.core import SignallingSessionPlus as Session
+from site.models.listeners import (check_available_stock, EventListener,
+                                   MAX_COMMIT_PASSES)
+from .models import db
+
+
+class StockItem(db.Model):
+    __tablename__ = 'stock_items'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_in_inventory = db.Column(db.Integer, default=0)
+    to_be_shipped = db.Column(db.Integer, default=0)
+
+    @property
+    def available_stock(self):
+        return self.stock_in_inventory - self.to_be_shipped
+
+
+class ClampedStockItem(StockItem):
+
+    @property
+    def available_stock(self):
+        return max(self.stock_in_inventory - self.to_be_shipped, 0)
+
+
+class HybridStockItem(db.Model):
+    __tablename__ = 'hybrid_stock_items'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_in_inventory = db.Column(db.Integer, default=0)
+    to_be_shipped = db.Column(db.Integer, default=0)
+
+    @hybrid_property
+    def available_stock(self):
+        return self.stock_in_inventory - self.to_be_shipped
+
+
+def test_available_stock_matching_the_query_passes():
+    assert check_available_stock(StockItem)
+    assert check_available_stock(HybridStockItem)
+
+
+def test_available_stock_differing_from_the_query_is_logged(caplog):
+    assert not check_available_stock(ClampedStockItem)
+    assert 'ClampedStockItem.available_stock is 0' in caplog.text
+
+
+class RecordingListener(EventListener):
+    """Records one more status change on each of its first `passes`"""
+
+    def __init__(self, passes):
+        self.passes = passes
+        self.processed = []
+
+    def process_records(self, session):
+        self.processed.append(list(session.pop_record(
+            'status_changed_shipments')))
+        if len(self.processed) <= self.passes:
+            session.record('status_changed_shipments', len(self.processed))
+
+
+def test_records_added_while_processing_are_processed(session):
+    listener = RecordingListener(passes=2)
+    listener.do_before_commit(session())
+    assert listener.processed == [[], [1], [2]]
+
+
+def test_records_which_keep_coming_raise(session):
+    listener = RecordingListener(passes=MAX_COMMIT_PASSES)
+    with pytest.raises(RuntimeError):
+        listener.do_before_commit(session())
+    assert len(listener.processed) == MAX_COMMIT_PASSES
+
+
+def test_records_added_late_fail_the_commit_after_the_configured_passes(
+        session):
+    listener = RecordingListener(passes=3)
+    listener.max_commit_passes = 3
+    event.listen(Session, 'before_commit', listener.do_before_commit)
+    try:
+        session.add(StockItem(stock_in_inventory=1))
+        with pytest.raises(RuntimeError) as e:
+            session.commit()
+        assert 'after 3 passes: status_changed_shipments' in str(e.value)
+        session.rollback()
+        assert StockItem.query.count() == 0
+        listener.passes = 0
+        session.add(StockItem(stock_in_inventory=1))
+        session.commit()
+        assert StockItem.query.count() == 1
+    finally:
+        event.remove(Session, 'before_commit', listener.do_before_commit)
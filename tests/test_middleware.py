@@ -0,0 +1,68 @@
+import gzip
+from StringIO import StringIO
+from werkzeug.test import Client
+from werkzeug.wrappers import Request, Response
+from site.middleware import CompressionMiddleware
+
+BODY = '{"rows": [%s]}' % ', '.join(['"row"'] * 200)
+
+
+@Request.application
+def plain_app(request):
+    response = Response(BODY, mimetype='application/json')
+    response.set_etag('abc')
+    if request.args.get('vary'):
+        response.headers['Vary'] = request.args['vary']
+    return response.make_conditional(request)
+
+
+@Request.application
+def small_app(request):
+    return Response('{}', mimetype='application/json')
+
+
+def get(app, path='/', method='GET', **headers):
+    client = Client(CompressionMiddleware(app), Response)
+    environ = dict(('HTTP_' + k.upper(), v) for k, v in headers.items())
+    return client.open(path, method=method, environ_overrides=environ)
+
+
+def test_compressed_response():
+    response = get(plain_app, accept_encoding='gzip')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == '"abc-gzip"'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.GzipFile(fileobj=StringIO(response.data)).read() == BODY
+
+
+def test_plain_responses_vary_too():
+    assert get(plain_app).headers['Vary'] == 'Accept-Encoding'
+    response = get(small_app, accept_encoding='gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    response = get(plain_app, method='HEAD', accept_encoding='gzip')
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_vary_is_merged():
+    response = get(plain_app, '/?vary=Cookie', accept_encoding='gzip')
+    assert response.headers.getlist('Vary') == ['Cookie, Accept-Encoding']
+    response = get(plain_app, '/?vary=accept-encoding')
+    assert response.headers.getlist('Vary') == ['accept-encoding']
+
+
+def test_gzip_etag_matches():
+    response = get(plain_app, accept_encoding='gzip',
+                   if_none_match='"abc-gzip"')
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"abc-gzip"'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_gzip_etag_matches_without_gzip():
+    response = get(plain_app, if_none_match='"abc-gzip"')
+    assert response.status_code == 304
+    assert response.headers['ETag'] == '"abc"'
+    response = get(plain_app, method='HEAD', accept_encoding='gzip',
+                   if_none_match='"abc-gzip"')
+    assert response.status_code == 304
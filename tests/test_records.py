@@ -0,0 +1,38 @@
+from .models import User
+
+
+def test_savepoint_rollback_keeps_the_records_before_it(session):
+    outer, inner = User(name='outer'), User(name='inner')
+    session().record('users', outer)
+    session().record('events', 1, unique=False)
+    session.begin_nested()
+    session().record('users', inner)
+    session().record('events', 2, unique=False)
+    session.rollback()
+    assert list(session().recorded('users')) == [outer]
+    assert session().recorded('events') == [1]
+    session.rollback()
+    assert session().recorded('users') is None
+
+
+def test_released_savepoint_keeps_its_records(session):
+    outer, inner = User(name='outer'), User(name='inner')
+    session().record('users', outer)
+    session.begin_nested()
+    session().record('users', inner)
+    session.commit()
+    assert list(session().recorded('users')) == [outer, inner]
+    session.commit()
+    assert session().recorded('users') is None
+
+
+def test_nested_savepoints_roll_back_to_their_own_records(session):
+    session().record('events', 1, unique=False)
+    session.begin_nested()
+    session().record('events', 2, unique=False)
+    session.begin_nested()
+    session().record('events', 3, unique=False)
+    session.rollback()
+    assert session().recorded('events') == [1, 2]
+    session.rollback()
+    assert session().recorded('events') == [1]
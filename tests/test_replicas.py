@@ -0,0 +1,80 @@
+import pytest
+from .conftest import make_app
+from .models import db, User
+
+
+@pytest.fixture
+def app(tmpdir):
+    """An app over two sqlite files, a primary and a replica which never
+    catches up, so that a read shows which one it went to"""
+    app = make_app(tmpdir, SQLALCHEMY_REPLICA_URIS=[
+        'sqlite:///%s' % tmpdir.join('replica.db')],
+        SQLALCHEMY_REPLICA_LAG=0)
+    with app.app_context():
+        db.create_all()
+        db.Model.metadata.create_all(
+            db.get_engine(app, bind='__replica_0__'))
+        db.session.add(User(email='a@example.com', name='A'))
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+
+def test_reads_go_to_the_replica(app, session):
+    assert User.query.all() == []
+    assert session.execute('SELECT count(*) FROM users').scalar() == 0
+
+
+def test_raw_selects_do_not_stick_to_the_primary(app, session):
+    session.execute('select 1')
+    session.execute(' SELECT id FROM users')
+    assert User.query.all() == []
+
+
+def test_locking_and_writing_sql_go_to_the_primary(app, session):
+    session.execute("UPDATE users SET name = 'B'")
+    assert [u.name for u in User.query.all()] == ['B']
+
+
+def test_writes_stick_to_the_primary_until_the_commit(app, session):
+    User.create(email='b@example.com')
+    assert User.query.count() == 0
+    user = User.build(email='c@example.com')
+    assert User.query.count() == 3
+    session.rollback()
+    assert User.query.count() == 0
+
+
+def test_pending_changes_read_the_primary(app, session):
+    session.add(User(email='c@example.com'))
+    with session.no_autoflush:
+        assert User.query.count() == 1
+
+
+def test_read_modify_write_reads_the_primary(app, session):
+    # On the replica the user is missing, and creating it again would
+    # break the unique email
+    User.update_or_create(
+        email='a@example.com', name='Changed', keys=['email'])
+    primary = db.get_engine(app)
+    assert primary.execute('SELECT name FROM users').fetchall() == [
+        ('Changed',)]
+    User.find_or_create(email='a@example.com', keys=['email'])
+    assert primary.execute('SELECT count(*) FROM users').scalar() == 1
+
+
+def test_commits_read_back_within_the_lag(app, session):
+    app.config['SQLALCHEMY_REPLICA_LAG'] = 60
+    user = User.create(email='b@example.com', name='B')
+    assert user.name == 'B'
+    assert User.query.count() == 2
+
+
+def test_released_savepoints_keep_reading_the_primary(app, session):
+    session.add(User(email='b@example.com'))
+    session.flush()
+    session.begin_nested()
+    session.commit()
+    assert User.query.count() == 2
+    session.commit()
+    assert User.query.count() == 0
@@ -0,0 +1,51 @@
+from datetime import datetime
+import pytest
+from werkzeug.exceptions import BadRequest
+from .models import Order
+
+SHIPPED = [None, datetime(2016, 1, 2), None, datetime(2016, 1, 1),
+           datetime(2016, 1, 2), None]
+
+
+@pytest.fixture
+def orders(app, session):
+    session.add_all([Order(shipped_at=shipped_at) for shipped_at in SHIPPED])
+    session.commit()
+    return Order.query.all()
+
+
+def pages(attr, descending, size=2):
+    seen = []
+    after = None
+    while True:
+        rows = Order.query.seek(
+            after, attr=attr, descending=descending).limit(size).all()
+        seen.extend(rows)
+        if len(rows) < size:
+            return seen
+        after = (getattr(rows[-1], attr), rows[-1].id)
+
+
+def test_nulls_come_last(orders):
+    expected = sorted(orders, key=lambda o: (
+        o.shipped_at is None, o.shipped_at, o.id))
+    assert Order.query.seek(attr='shipped_at').all() == expected
+    assert pages('shipped_at', False) == expected
+
+
+def test_nulls_come_first_when_descending(orders):
+    expected = sorted(orders, key=lambda o: (
+        o.shipped_at is None, o.shipped_at, o.id), reverse=True)
+    assert Order.query.seek(attr='shipped_at', descending=True).all() == (
+        expected)
+    assert pages('shipped_at', True) == expected
+
+
+def test_pages_by_id(orders):
+    assert pages('id', False, size=4) == orders
+    assert pages('id', True, size=4) == orders[::-1]
+
+
+def test_malformed_values_are_bad_requests(orders):
+    with pytest.raises(BadRequest):
+        Order.query.seek(('ten', 1), attr='total').all()
@@ -0,0 +1,41 @@
+from decimal import Decimal
+from site.models.modelbase import load_relationships
+from site.models.instrumentation import sql_instrumentation
+from .models import db, User, Order, Item
+
+
+def add_users(session):
+    for i in range(3):
+        user = User(email='user%d@example.com' % i, name='User %d' % i)
+        for j in range(2):
+            order = Order(total=Decimal('10.00'), user=user)
+            order.items = [Item(sku='SKU%d' % k) for k in range(2)]
+        session.add(user)
+    session.commit()
+    session.expunge_all()
+
+
+def test_expanded_objects_get_their_default_rels(app, session):
+    plan = User.serialization_plan(rels_to_expand=['orders'])
+    assert plan.rel_paths == set([('orders',), ('orders', 'items')])
+
+
+def test_load_relationships_loads_the_default_rels_of_children(
+        app, session):
+    add_users(session)
+    users = User.query.all()
+    load_relationships(users, rels_to_expand=['orders'])
+    with sql_instrumentation.record() as queries:
+        dicts = [u.todict(rels_to_expand=['orders']) for u in users]
+    assert queries.count == 0
+    assert all(len(order['items']) == 2
+               for d in dicts for order in d['orders'])
+
+
+def test_eager_load_loads_the_default_rels_of_children(app, session):
+    add_users(session)
+    users = User.query.eager_load(rels_to_expand=['orders']).all()
+    with sql_instrumentation.record() as queries:
+        for user in users:
+            user.todict(rels_to_expand=['orders'])
+    assert queries.count == 0
@@ -0,0 +1,28 @@
+import pytest
+from .models import Item
+
+
+@pytest.fixture
+def items(app, session):
+    session.add_all([Item(sku='SKU%02d' % i, quantity=i) for i in range(10)])
+    session.commit()
+
+
+def test_windows_cover_every_row(items, session):
+    skus = [item.sku for item in Item.query.order_by(
+        Item.sku.desc()).stream(batch_size=3)]
+    assert skus == ['SKU%02d' % i for i in range(10)]
+    assert len(session.identity_map) == 0
+
+
+def test_changes_survive_the_expunge(items, session):
+    for item in Item.query.stream(batch_size=3):
+        item.quantity += 100
+    session.commit()
+    assert sorted(i.quantity for i in Item.query) == range(100, 110)
+
+
+def test_limit_and_offset_select_the_rows(items):
+    query = Item.query.order_by(Item.quantity.desc()).offset(2).limit(5)
+    skus = [item.sku for item in query.stream(batch_size=2)]
+    assert skus == ['SKU%02d' % i for i in (3, 4, 5, 6, 7)]
@@ -0,0 +1,14 @@
+from site import utils
+from site.utils import LRUCache
+
+
+def test_expired_entries_are_not_contained(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'time', lambda: now[0])
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+    assert 'a' in cache and cache.get('a') == 1
+    now[0] += 11
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert 'b' not in cache
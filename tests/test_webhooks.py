@@ -0,0 +1,47 @@
+from site.webhooks import webhooks, WebhookDispatcher
+from .models import db, User
+
+sent = []
+
+
+def record_hook(*args):
+    sent.append(args)
+
+
+def test_hooks_run_after_commit_only(app, session):
+    del sent[:]
+    webhooks.app = app
+    session.add(User(name='a'))
+    webhooks.enqueue(session(), record_hook, 1)
+    session.rollback()
+    session.add(User(name='b'))
+    webhooks.enqueue(session(), record_hook, 2)
+    session.commit()
+    webhooks.queue.join()
+    assert sent == [(2,)]
+
+
+def test_init_app_sizes_the_connection_pools(app):
+    dispatcher = WebhookDispatcher()
+    app.config['WEBHOOK_WORKERS'] = 12
+    dispatcher.init_app(app)
+    for prefix in ('http://', 'https://'):
+        assert dispatcher.http.get_adapter(prefix)._pool_maxsize == 12
+
+
+def test_savepoints_keep_the_hooks_of_the_transaction(app, session):
+    del sent[:]
+    webhooks.app = app
+    session.add(User(name='a'))
+    webhooks.enqueue(session(), record_hook, 1)
+    session.begin_nested()
+    webhooks.enqueue(session(), record_hook, 2)
+    session.rollback()
+    session.begin_nested()
+    webhooks.enqueue(session(), record_hook, 3)
+    session.commit()
+    webhooks.queue.join()
+    assert sent == []
+    session.commit()
+    webhooks.queue.join()
+    assert sorted(sent) == [(1,), (3,)]